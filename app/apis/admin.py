@@ -0,0 +1,39 @@
+from fastapi import APIRouter
+
+from app.cache_sync import cache_sync
+from app.database import engine, async_engine, pool_metrics, async_pool_metrics
+from app.subscriptions import dispatcher
+from app.write_behind import write_behind
+
+router = APIRouter(prefix="/api/admin")
+
+
+@router.get("/pool")
+async def get_pool_metrics():
+    """Connection pool settings and checkout metrics of this worker
+    """
+    return {
+        "sync": pool_metrics.snapshot(engine.pool),
+        "async": async_pool_metrics.snapshot(async_engine.sync_engine.pool),
+    }
+
+
+@router.get("/write-behind")
+async def get_write_behind_metrics():
+    """Buffer depth, flush latency and coalescing ratio of the datapoint write-behind buffer
+    """
+    return write_behind.snapshot()
+
+
+@router.get("/subscriptions")
+async def get_subscription_metrics():
+    """Open change subscriptions of this worker and the changes fanned out to them
+    """
+    return dispatcher.snapshot()
+
+
+@router.get("/cache-sync")
+async def get_cache_sync_metrics():
+    """Cross-worker cache invalidation state of this worker
+    """
+    return cache_sync.snapshot()
@@ -1,52 +1,314 @@
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional
+
 from fastapi import APIRouter, HTTPException, Depends, Query, Path
 
-from sqlalchemy.orm import Session
+from sqlalchemy import func, insert, select, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from app.database import get_db
+from app.database import get_async_db
 from app.models.sql_alchemy_models import Object, Datapoint, ObjectDatapoint
-from app.models.pydantic_models import DatapointCreate, DatapointUpdate, DatapointResponse
+from app.models.pydantic_models import (
+    DatapointCreate, DatapointUpdate, DatapointResponse,
+    DatapointBulkCreate, DatapointBulkCreateResponse, DatapointBulkError,
+    DatapointValuesUpdate, DatapointValuesUpdateResponse,
+    DatapointHistoryResponse, DatapointPage, DatapointBatch
+)
+from app.change_tokens import change_tokens
+from app.datapoint_values import apply_datapoint_values, coalesce_updates
+from app.freshness import FRESHNESS_ENABLED, fresh_until_for, touch_associations
+from app.history import bucket_seconds_for, query_history, record_history
+from app.loaders import Loaders, get_loaders
+from app.pagination import decode_cursor, encode_cursor
+from app.queries import QUERY_DATAPOINT, QUERY_DATAPOINTS_BY_IDS, datapoint_listing
+from app.subscriptions import publish_changes
+from app.write_behind import write_behind
 
 router = APIRouter(prefix="/api/datapoint")
 
+# String columns of the bulk insert whose length the database enforces
+BULK_COLUMN_LENGTHS = {
+    field: Datapoint.__table__.c[field].type.length for field in ("name", "unit", "type")
+}
+
+
+def _too_long_field(item) -> Optional[str]:
+    for field, length in BULK_COLUMN_LENGTHS.items():
+        if len(getattr(item, field) or "") > length:
+            return field
+    return None
+
+
+@router.post("/bulk", response_model=DatapointBulkCreateResponse, status_code=201)
+async def create_datapoints_bulk(payload: DatapointBulkCreate, db: AsyncSession = Depends(get_async_db)):
+    """Create many datapoints, possibly across many objects, in one transaction.
+
+    Items referencing a missing object, lacking a value or type, or with a field longer than its
+    column are reported in `errors`; the other items are inserted with one multi-row INSERT per table.
+    """
+    try:
+        object_ids = {item.object_id for item in payload.items}
+        existing_ids = set((await db.execute(select(Object.id).where(Object.id.in_(object_ids)))).scalars())
+
+        errors, valid_items = [], []
+        for index, item in enumerate(payload.items):
+            too_long = _too_long_field(item)
+            if item.object_id not in existing_ids:
+                detail = f"Object with id {item.object_id} not found"
+            elif item.value is None:
+                detail = "value is required"
+            elif not item.type:
+                detail = "type is required"
+            elif too_long:
+                detail = f"{too_long} is longer than {BULK_COLUMN_LENGTHS[too_long]} characters"
+            else:
+                valid_items.append(item)
+                continue
+            errors.append(DatapointBulkError(index=index, object_id=item.object_id, detail=detail))
+
+        created = []
+        if valid_items:
+            inserted = (await db.execute(
+                insert(Datapoint).returning(
+                    Datapoint.id, Datapoint.created_at, Datapoint.updated_at, sort_by_parameter_order=True
+                ),
+                [
+                    {
+                        "name": item.name,
+                        "value": item.value,
+                        "unit": item.unit,
+                        "is_fresh": item.is_fresh,
+                        "type": item.type,
+                        **({"fresh_until": fresh_until_for(item.type)} if FRESHNESS_ENABLED else {}),
+                    }
+                    for item in valid_items
+                ]
+            )).all()
+
+            await db.execute(
+                insert(ObjectDatapoint),
+                [{"object_FK": item.object_id, "datapoint_FK": row.id} for item, row in zip(valid_items, inserted)]
+            )
+            await record_history(db, [(row.id, item.value) for item, row in zip(valid_items, inserted)])
+            await publish_changes(db, [row.id for row in inserted])
+            await db.commit()
+            change_tokens.bump_datapoints()
+
+            created = [
+                DatapointResponse(
+                    id=row.id,
+                    name=item.name,
+                    value=item.value,
+                    unit=item.unit,
+                    created_at=row.created_at,
+                    updated_at=row.updated_at,
+                    is_fresh=item.is_fresh,
+                    type=item.type,
+                    object_id=item.object_id
+                )
+                for item, row in zip(valid_items, inserted)
+            ]
+
+        return DatapointBulkCreateResponse(created=created, errors=errors)
+
+    except Exception as e:
+        await db.rollback()
+        raise HTTPException(status_code=500, detail=f"Error creating datapoints: {str(e)}")
+
+
+@router.put("/values", response_model=DatapointValuesUpdateResponse)
+async def update_datapoint_values(payload: DatapointValuesUpdate, db: AsyncSession = Depends(get_async_db)):
+    """Apply value and freshness updates for many datapoints in one statement.
+
+    Unknown ids and updates that do not change anything are skipped; only the changed ids are returned.
+    """
+    try:
+        updates = coalesce_updates((item.id, item.value, item.is_fresh) for item in payload.updates)
+        for datapoint_id, (value, is_fresh) in updates.items():
+            write_behind.discard(datapoint_id, value=value is not None, is_fresh=is_fresh is not None)
+        changed = await apply_datapoint_values(db, updates, stamp_value_writes=write_behind.enabled)
+        await db.commit()
+        if changed:
+            change_tokens.bump_datapoints()
+
+        return DatapointValuesUpdateResponse(changed=[row.id for row in changed])
+
+    except Exception as e:
+        await db.rollback()
+        raise HTTPException(status_code=500, detail=f"Error updating datapoint values: {str(e)}")
+
+
+MAX_BATCH_IDS = 1000
+
+
+def _datapoint_response(datapoint: Datapoint, object_id) -> DatapointResponse:
+    current = write_behind.overlay({'id': datapoint.id, 'value': datapoint.value, 'is_fresh': datapoint.is_fresh})
+    return DatapointResponse(
+        id=datapoint.id,
+        name=datapoint.name,
+        value=current['value'],
+        unit=datapoint.unit,
+        created_at=datapoint.created_at,
+        updated_at=datapoint.updated_at,
+        is_fresh=current['is_fresh'],
+        type=datapoint.type,
+        object_id=object_id
+    )
+
+
+def _after_cursor(cursor: str, by_update: bool):
+    """WHERE condition selecting the rows after the position encoded in `cursor`
+    """
+    position = decode_cursor(cursor)
+    try:
+        if by_update:
+            return tuple_(Datapoint.updated_at, Datapoint.id) > tuple_(
+                datetime.fromisoformat(position["updated_at"]), int(position["id"])
+            )
+        if "updated_at" in position:
+            raise ValueError("Cursor of a listing with updated_since")
+        return Datapoint.id > int(position["id"])
+    except (KeyError, TypeError) as e:
+        raise ValueError("Invalid cursor") from e
+
+
+@router.get("/", response_model=DatapointPage)
+async def list_datapoints(
+        datapoint_type: Optional[str] = Query(None, alias="type", description="Only datapoints of this type"),
+        is_fresh: Optional[bool] = None,
+        unit: Optional[str] = None,
+        updated_since: Optional[datetime] = Query(None, description="Only datapoints updated at or after this time"),
+        object_id: Optional[int] = Query(None, description="Only datapoints of this object and its descendants"),
+        cursor: Optional[str] = Query(None, description="next_cursor of the previous page"),
+        limit: int = Query(100, ge=1, le=1000),
+        db: AsyncSession = Depends(get_async_db)
+):
+    """List datapoints one page at a time, ordered by id, or by (updated_at, id) with `updated_since`.
+
+    Pages are keyset-paginated: each one is a bounded range scan of a (filter, id) index
+    (migrations/0005_datapoint_listing_indexes.sql), however deep into the listing it is.
+    """
+    try:
+        by_update = updated_since is not None
+        # naive datetimes are taken as UTC
+        if by_update and not updated_since.tzinfo:
+            updated_since = updated_since.replace(tzinfo=timezone.utc)
+        query = datapoint_listing(datapoint_type, is_fresh, unit, updated_since, object_id)
+
+        if cursor:
+            try:
+                query = query.where(_after_cursor(cursor, by_update))
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+
+        # one extra row tells whether there is a next page
+        rows = (await db.execute(query.limit(limit + 1))).all()
+        page = rows[:limit]
+
+        items = [_datapoint_response(datapoint, datapoint_object_id) for datapoint, datapoint_object_id in page]
+
+        next_cursor = None
+        if len(rows) > limit:
+            last = page[-1][0]
+            position = {"id": last.id}
+            if by_update:
+                position["updated_at"] = last.updated_at.isoformat()
+            next_cursor = encode_cursor(position)
+
+        return DatapointPage(items=items, next_cursor=next_cursor)
+
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error listing datapoints: {str(e)}")
+
+
+@router.get("/batch", response_model=DatapointBatch)
+async def get_datapoints_batch(
+        ids: List[int] = Query(..., description="Datapoint ids, repeated: ?ids=1&ids=2"),
+        db: AsyncSession = Depends(get_async_db)
+):
+    """Get many datapoints with their object_id in one query, whatever the number of ids
+    """
+    ids = list(dict.fromkeys(ids))
+    if len(ids) > MAX_BATCH_IDS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_IDS} ids per request")
+    try:
+        rows = (await db.execute(QUERY_DATAPOINTS_BY_IDS, {"ids": ids})).all()
+        found = {datapoint.id: (datapoint, object_id) for datapoint, object_id in rows}
+
+        return DatapointBatch(
+            items=[_datapoint_response(*found[datapoint_id]) for datapoint_id in ids if datapoint_id in found],
+            missing=[datapoint_id for datapoint_id in ids if datapoint_id not in found]
+        )
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error retrieving datapoints: {str(e)}")
+
 
 @router.get("/{id}" , response_model=DatapointResponse)
-async def get_datapoint(id: int, db: Session = Depends(get_db)):
+async def get_datapoint(id: int, db: AsyncSession = Depends(get_async_db)):
     try:
-        datapoint = db.query(Datapoint).filter(Datapoint.id == id).first()
-        if not datapoint:
+        row = (await db.execute(QUERY_DATAPOINT, {"datapoint_id": id})).first()
+        if not row:
             raise HTTPException(status_code=404, detail=f"Datapoint with id {id} not found")
 
-        association = db.query(ObjectDatapoint).filter(
-            ObjectDatapoint.datapoint_FK == datapoint.id
-        ).first()
-        object_id = association.object_FK if association else None
+        return _datapoint_response(*row)
 
-        return DatapointResponse(
-            id=datapoint.id,
-            name=datapoint.name,
-            value=datapoint.value,
-            unit=datapoint.unit,
-            created_at=datapoint.created_at,
-            updated_at=datapoint.updated_at,
-            is_fresh=datapoint.is_fresh,
-            type=datapoint.type,
-            object_id=object_id
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error retrieving datapoint: {str(e)}")
+
+
+@router.get("/{id}/history", response_model=DatapointHistoryResponse)
+async def get_datapoint_history(
+        id: int,
+        start: Optional[datetime] = Query(None, description="Start of the range, defaults to 24 hours before end"),
+        end: Optional[datetime] = Query(None, description="End of the range (exclusive), defaults to now"),
+        max_points: int = Query(500, ge=1, le=10000, description="Upper bound on the number of buckets returned"),
+        bucket_seconds: Optional[int] = Query(None, ge=1, description="Bucket width, derived from max_points if omitted"),
+        db: AsyncSession = Depends(get_async_db)
+):
+    """Value history of a datapoint, downsampled server-side to min/max/avg/last per time bucket
+    """
+    try:
+        end = end or datetime.now(timezone.utc)
+        start = start or end - timedelta(days=1)
+        # naive datetimes are taken as UTC
+        start, end = [moment if moment.tzinfo else moment.replace(tzinfo=timezone.utc) for moment in (start, end)]
+        if start >= end:
+            raise HTTPException(status_code=400, detail="start must be before end")
+        bucket_seconds = max(bucket_seconds or 1, bucket_seconds_for(start, end, max_points))
+
+        if not (await db.execute(select(Datapoint.id).where(Datapoint.id == id))).first():
+            raise HTTPException(status_code=404, detail=f"Datapoint with id {id} not found")
+
+        points = await query_history(db, id, start, end, bucket_seconds)
+
+        return DatapointHistoryResponse(
+            datapoint_id=id,
+            start=start,
+            end=end,
+            bucket_seconds=bucket_seconds,
+            points=[dict(point) for point in points]
         )
 
     except HTTPException as e:
         raise e
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error retrieving datapoint: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error retrieving datapoint history: {str(e)}")
 
 
 @router.put("/{id}", response_model=DatapointResponse)
 async def update_datapoint(
         id: int,
         datapoint_data: DatapointUpdate,
-        db: Session = Depends(get_db)
+        db: AsyncSession = Depends(get_async_db),
+        loaders: Loaders = Depends(get_loaders)
 ):
     try:
-        datapoint = db.query(Datapoint).filter(Datapoint.id == id).first()
+        datapoint = await loaders.datapoints.load(id)
         if not datapoint:
             raise HTTPException(status_code=404, detail=f"Datapoint with id {id} not found")
 
@@ -54,10 +316,35 @@ async def update_datapoint(
                     datapoint_data.is_fresh is not None, datapoint_data.type]):
             raise HTTPException(status_code=400, detail="At least one field must be provided for update")
 
+        value_only = datapoint_data.name is None and datapoint_data.unit is None and datapoint_data.type is None
+        # buffered: the value is committed by the next write-behind flush
+        if write_behind.enabled and value_only and await write_behind.submit(
+                datapoint.id, datapoint_data.value, datapoint_data.is_fresh):
+            # reads show pending values right away
+            change_tokens.bump_datapoints()
+            object_id = await loaders.datapoint_object_ids.load(datapoint.id)
+            current = write_behind.overlay({'id': datapoint.id, 'value': datapoint.value, 'is_fresh': datapoint.is_fresh})
+
+            return DatapointResponse(
+                id=datapoint.id,
+                name=datapoint.name,
+                value=current['value'],
+                unit=datapoint.unit,
+                created_at=datapoint.created_at,
+                updated_at=datapoint.updated_at,
+                is_fresh=current['is_fresh'],
+                type=datapoint.type,
+                object_id=object_id
+            )
+
+        write_behind.discard(datapoint.id, value=datapoint_data.value is not None,
+                             is_fresh=datapoint_data.is_fresh is not None)
+
         if datapoint_data.name is not None:
             datapoint.name = datapoint_data.name
-        if datapoint_data.value is not None:
+        if datapoint_data.value is not None and datapoint_data.value != datapoint.value:
             datapoint.value = datapoint_data.value
+            await record_history(db, [(datapoint.id, datapoint.value)])
         if datapoint_data.unit is not None:
             datapoint.unit = datapoint_data.unit
         if datapoint_data.is_fresh is not None:
@@ -65,13 +352,24 @@ async def update_datapoint(
         if datapoint_data.type is not None:
             datapoint.type = datapoint_data.type
 
-        db.commit()
-        db.refresh(datapoint)
+        if datapoint_data.value is not None:
+            # a new reading renews the freshness of the datapoint
+            if FRESHNESS_ENABLED:
+                datapoint.fresh_until = fresh_until_for(datapoint.type)
+                if datapoint_data.is_fresh is None:
+                    datapoint.is_fresh = True
+            if write_behind.enabled:
+                # a value buffered earlier, in any worker, is not flushed over this one
+                datapoint.value_updated_at = func.now()
+            await touch_associations(db, [datapoint.id])
+
+        await publish_changes(db, [datapoint.id])
+        await db.commit()
+        change_tokens.bump_datapoints()
+        await db.refresh(datapoint)
 
-        association = db.query(ObjectDatapoint).filter(
-            ObjectDatapoint.datapoint_FK == datapoint.id
-        ).first()
-        object_id = association.object_FK if association else None
+        # loaded with the datapoint, no second query
+        object_id = await loaders.datapoint_object_ids.load(datapoint.id)
 
         return DatapointResponse(
             id=datapoint.id,
@@ -86,28 +384,34 @@ async def update_datapoint(
         )
 
     except HTTPException as e:
-        db.rollback()
+        await db.rollback()
         raise e
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=500, detail=f"Error updating datapoint: {str(e)}")
 
 
 @router.delete("/{id}", status_code=204)
-async def delete_datapoint(id: int, db: Session = Depends(get_db)):
+async def delete_datapoint(
+        id: int,
+        db: AsyncSession = Depends(get_async_db),
+        loaders: Loaders = Depends(get_loaders)
+):
     try:
-        datapoint = db.query(Datapoint).filter(Datapoint.id == id).first()
+        datapoint = await loaders.datapoints.load(id)
         if not datapoint:
             raise HTTPException(status_code=404, detail=f"Datapoint with id {id} not found")
 
-        db.delete(datapoint)
-        db.commit()
+        await db.delete(datapoint)
+        await db.commit()
+        write_behind.discard(id)
+        change_tokens.bump_datapoints()
 
         return None  # 204 no content
 
     except HTTPException as e:
-        db.rollback()
+        await db.rollback()
         raise e
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=500, detail=f"Error deleting datapoint: {str(e)}")
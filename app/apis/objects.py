@@ -1,46 +1,138 @@
 import json
 
-from fastapi import APIRouter, HTTPException, Depends, Query, Path
+from fastapi import APIRouter, HTTPException, Depends, Query, Path, Header, Response
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from sqlalchemy import text
 from typing import List, Dict, Optional
 from datetime import datetime
 
-from app.database import get_db
-from app.models.sql_alchemy_models import Object, Datapoint, ObjectDatapoint
+from app.database import get_db, get_async_db
+from app.models.sql_alchemy_models import Object, Datapoint
 from app.models.pydantic_models import (
     ObjectBase,
     ObjectCreate, ObjectUpdate, ObjectInDB,
     DatapointResponse, DatapointCreate
 )
 
-from app.utils import build_tree, build_subtree_with_datapoints, update_object_association, resolve_relative_path, build_tree_with_node_datapoints
+from app import closure, queries
+from app.cache_sync import publish_object_removal, publish_object_upsert
+from app.change_tokens import change_tokens, etag_matches
+from app.hierarchy_cache import hierarchy_cache
+from app.freshness import FRESHNESS_ENABLED, fresh_until_for
+from app.history import record_history
+from app.instrumentation import measure
+from app.loaders import Loaders, get_loaders
+from app.subscriptions import publish_changes
+from app.responses import MsgspecJSONResponse, encode_json, not_modified
+from app.path_query import PathSyntaxError, QUERY_PATH_PRUNED, collect_path_rows, compile_path, execute_path, sql_params
+from app.write_behind import write_behind
+from app.utils import (
+    build_subtree_with_datapoints, update_object_association, build_tree_structs, build_tree_structs_with_node_datapoints,
+    index_children
+)
 
 router = APIRouter(prefix="/api/objects")
 
 
-@router.get("/tree")
+@router.get("/tree", response_class=MsgspecJSONResponse)
 def get_objects_tree(
+        root: Optional[int] = Query(None, description="Return the objects below this object instead of the top-level objects"),
+        depth: Optional[int] = Query(None, ge=1, description="Number of levels to return, all levels if omitted"),
+        if_none_match: Optional[str] = Header(None),
         db: Session = Depends(get_db)
 ):
-    """Get the tree hierarchy of objects
+    """Get the tree hierarchy of objects, 304 if If-None-Match holds the ETag of the current version.
+
+    `root` and `depth` let clients expand the tree one level at a time: every node reports its
+    `child_count`, also when its children were cut off by the depth limit.
     """
-    _query_all_objects = """SELECT
-        id,
-        name,
-        type,
-        parent_id
-    FROM public."object"
-    ORDER BY
-        CASE WHEN parent_id IS NULL THEN 0 ELSE 1 END,
-        parent_id,
-        id;
+    etag = change_tokens.etag("tree", root, depth, hierarchy_cache.version)
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag)
+
+    if root is None and depth is None:
+        hierarchy_cache.ensure_loaded(db)
+        with measure("build"):
+            # built and encoded once per hierarchy version
+            version, body = hierarchy_cache.tree_json()
+    else:
+        try:
+            cached = hierarchy_cache.subtree(root, depth)
+        except KeyError:
+            raise HTTPException(status_code=404, detail="Object not found")
+
+        if cached is not None:
+            version, nodes = cached
+        else:
+            # cold cache: only read the requested levels instead of loading the whole hierarchy
+            version = hierarchy_cache.version
+            rows = closure.tree_levels(db, root, depth)
+            if rows is None:
+                raise HTTPException(status_code=404, detail="Object not found")
+            with measure("build"):
+                nodes = build_tree_structs(
+                    index_children(rows), root, child_counts={row['id']: row['child_count'] for row in rows}
+                )
+        with measure("serialize"):
+            body = encode_json(nodes)
+
+    return MsgspecJSONResponse(body, headers={
+        "ETag": change_tokens.etag("tree", root, depth, version), "Cache-Control": "no-cache"
+    })
+
+
+MAX_BATCH_IDS = 1000
+
+
+@router.get("/batch")
+def get_objects_batch(
+        ids: List[int] = Query(..., description="Object ids, repeated: ?ids=1&ids=2"),
+        include_children: bool = False,
+        include_datapoints: bool = True,
+        db: Session = Depends(get_db)
+):
+    """Get many objects, each shaped like GET /api/objects/{object_id}, in a constant number of queries:
+    one for the objects, one for their children and one for their datapoints.
     """
-    objects_result = db.execute(text(_query_all_objects))
-    objects = [dict(row) for row in objects_result.mappings()]
-    tree = build_tree(objects)
-
-    return tree
+    ids = list(dict.fromkeys(ids))
+    if len(ids) > MAX_BATCH_IDS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_IDS} ids per request")
+
+    objects = {_object.id: _object for _object in db.execute(queries.QUERY_OBJECTS_BY_IDS, {"ids": ids}).scalars()}
+    found_ids = [object_id for object_id in ids if object_id in objects]
+
+    children = {object_id: [] for object_id in found_ids}
+    if include_children and found_ids:
+        for child in db.execute(queries.QUERY_CHILD_OBJECTS_BY_IDS, {"ids": found_ids}).scalars():
+            children[child.parent_id].append(child)
+
+    datapoints = {object_id: [] for object_id in found_ids}
+    if include_datapoints and found_ids:
+        _datapoint_result = db.execute(queries.QUERY_DATAPOINTS_OF_OBJECTS, {"ids": found_ids})
+        for row in _datapoint_result.mappings():
+            datapoints[row['object_FK']].append(write_behind.overlay(
+                {"id": row['id'], "name": row['name'], "value": row['value'], "unit": row['unit'], "type": row['type']}
+            ))
+
+    items = []
+    for object_id in found_ids:
+        _object = objects[object_id]
+        result = {
+            "id": _object.id,
+            "name": _object.name,
+            "type": _object.type,
+            "location_details": _object.location_details,
+            "parent_object_id": _object.parent_id,
+            "created_at": _object.created_at,
+            "updated_at": _object.updated_at
+        }
+        if include_children:
+            result["children"] = children[object_id]
+        if include_datapoints:
+            result["datapoints"] = datapoints[object_id]
+        items.append(result)
+
+    return {"items": items, "missing": [object_id for object_id in ids if object_id not in objects]}
 
 
 @router.get("/{object_id}")
@@ -48,9 +140,19 @@ def get_object(
         object_id: int = Path(..., title="The ID of the object to retrieve"),
         include_children: bool = False,
         include_datapoints: bool = True,
+        response: Response = None,
+        if_none_match: Optional[str] = Header(None),
         db: Session = Depends(get_db)
 ):
-    _object = db.query(Object).filter(Object.id == object_id).first()
+    # tokens are read before the queries, the ETag can only be older than the data
+    etag = change_tokens.etag(
+        "object", object_id, int(include_children), int(include_datapoints),
+        hierarchy_cache.version, change_tokens.datapoints if include_datapoints else 0
+    )
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag)
+
+    _object = db.execute(queries.QUERY_OBJECT, {"object_id": object_id}).scalars().first()
 
     if not _object:
         raise HTTPException(status_code=404, detail="Object not found")
@@ -66,30 +168,31 @@ def get_object(
     }
 
     if include_children:
-        children = db.query(Object).filter(Object.parent_id == object_id).all()
+        children = db.execute(queries.QUERY_CHILD_OBJECTS, {"object_id": object_id}).scalars().all()
         result["children"] = children
 
     if include_datapoints:
-        _datapoint_query = f"""select d.id, d.name, d.value, d.unit, d.type from "object" o
-                    join object_datapoint od on o.id = od."object_FK"
-                    join datapoint d ON d.id = od."datapoint_FK"
-                    where o.id = {object_id}"""
-
-        _datapoint_result = db.execute(text(_datapoint_query))
+        _datapoint_result = db.execute(queries.QUERY_OBJECT_DATAPOINTS, {"object_id": object_id})
         _columns = _datapoint_result.keys()
         _rows = _datapoint_result.fetchall()
-        result["datapoints"] =  [dict(zip(_columns, row)) for row in _rows]
+        result["datapoints"] = [write_behind.overlay(dict(zip(_columns, row))) for row in _rows]
 
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "no-cache"
     return result
 
 
 @router.put("/{object_id}") # , response_model=ObjectInDB)
-def update_object(
+async def update_object(
         object_id: int = Path(..., title="The ID of the object to update"),
         object_data: ObjectUpdate = None,
-        db: Session = Depends(get_db)
+        db: AsyncSession = Depends(get_async_db),
+        loaders: Loaders = Depends(get_loaders)
 ):
-    _object = db.query(Object).filter(Object.id == object_id).first()
+    # queued together, the object and its new parent are read with one query
+    object_load = loaders.objects.load(object_id)
+    parent_load = loaders.objects.load(object_data.parent_id) if object_data.parent_id else None
+    _object = await object_load
     if not _object:
         raise HTTPException(status_code=404, detail="Object not found")
 
@@ -98,10 +201,14 @@ def update_object(
             raise HTTPException(status_code=400, detail="Object cannot be its own parent")
 
         if object_data.parent_id > 0:
-            parent = db.query(Object).filter(Object.id == object_data.parent_id).first()
-            if not parent:
+            if not await parent_load:
                 raise HTTPException(status_code=400, detail="Parent object does not exist")
 
+            if await closure.is_descendant(db, object_id, object_data.parent_id):
+                raise HTTPException(status_code=400, detail="Object cannot be moved under its own descendant")
+
+    reparented = object_data.parent_id is not None and object_data.parent_id != _object.parent_id
+
     if object_data.name is not None:
         _object.name = object_data.name
 
@@ -116,18 +223,26 @@ def update_object(
 
     _object.updated_at = datetime.now()
 
-    db.commit()
-    db.refresh(_object)
+    if reparented:
+        await closure.move_subtree(db, object_id, _object.parent_id)
+
+    await publish_object_upsert(db, _object)
+    await db.commit()
+    await db.refresh(_object)
+    hierarchy_cache.upsert(_object)
 
     return _object
 
 
 @router.post("/", status_code=201)
-async def create_object(object_data: ObjectCreate, db: Session = Depends(get_db)):
+async def create_object(
+        object_data: ObjectCreate,
+        db: AsyncSession = Depends(get_async_db),
+        loaders: Loaders = Depends(get_loaders)
+):
     try:
         if object_data.parent_id:
-            parent = db.query(Object).filter(Object.id == object_data.parent_id).first()
-            if not parent:
+            if not await loaders.objects.load(object_data.parent_id):
                 raise HTTPException(status_code=400, detail=f"Parent object with id {object_data.parent_id} not found")
 
         new_object = Object(
@@ -138,27 +253,37 @@ async def create_object(object_data: ObjectCreate, db: Session = Depends(get_db)
         )
 
         db.add(new_object)
-        db.commit()
-        db.refresh(new_object)
+        await db.flush()
+        await closure.add_object(db, new_object.id, new_object.parent_id)
+        await publish_object_upsert(db, new_object)
+
+        await db.commit()
+        await db.refresh(new_object)
+        hierarchy_cache.upsert(new_object)
 
         return new_object
 
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=500, detail=f"Error creating object: {str(e)}")
 
 
 @router.delete("/{object_id}", status_code=204)
-def delete_object(
+async def delete_object(
         object_id: int = Path(..., title="The ID of the object to delete"),
-        db: Session = Depends(get_db)
+        db: AsyncSession = Depends(get_async_db),
+        loaders: Loaders = Depends(get_loaders)
 ):
-    _object = db.query(Object).filter(Object.id == object_id).first()
+    _object = await loaders.objects.load(object_id)
     if not _object:
         raise HTTPException(status_code=404, detail="Object not found")
 
-    db.delete(_object)
-    db.commit()
+    # descendants and their object_closure rows go with ON DELETE CASCADE
+    await db.delete(_object)
+    await publish_object_removal(db, object_id)
+    await db.commit()
+    loaders.objects.clear(object_id)
+    hierarchy_cache.remove(object_id)
 
     return None
 
@@ -167,9 +292,14 @@ def delete_object(
 async def create_datapoint(
         object_id: int,
         datapoint_data: DatapointCreate,
-        db: Session = Depends(get_db)
+        db: AsyncSession = Depends(get_async_db),
+        loaders: Loaders = Depends(get_loaders)
 ):
     try:
+        # checked before the insert, update_object_association then finds the object in the loader
+        if not await loaders.objects.load(object_id):
+            raise HTTPException(status_code=404, detail=f"Object with id {object_id} not found")
+
         new_datapoint = Datapoint(
             name=datapoint_data.name,
             value=datapoint_data.value,
@@ -177,14 +307,19 @@ async def create_datapoint(
             is_fresh=datapoint_data.is_fresh,
             type=datapoint_data.type
         )
+        if FRESHNESS_ENABLED:
+            new_datapoint.fresh_until = fresh_until_for(datapoint_data.type)
 
         db.add(new_datapoint)
-        db.flush()
+        await db.flush()
 
-        update_object_association(db, new_datapoint.id, object_id)
+        await update_object_association(db, new_datapoint.id, object_id, loaders, replace=False)
+        await record_history(db, [(new_datapoint.id, new_datapoint.value)])
+        await publish_changes(db, [new_datapoint.id])
 
-        db.commit()
-        db.refresh(new_datapoint)
+        await db.commit()
+        change_tokens.bump_datapoints()
+        await db.refresh(new_datapoint)
 
         return DatapointResponse(
             id=new_datapoint.id,
@@ -199,81 +334,51 @@ async def create_datapoint(
         )
 
     except HTTPException as e:
-        db.rollback()
+        await db.rollback()
         raise e
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=500, detail=f"Error creating datapoint: {str(e)}")
 
 
-@router.get("/query/{object_id}/{path:path}")
-async def query_path(object_id: int, path: str, db: Session = Depends(get_db)):
+@router.get("/query/{object_id}/{path:path}", response_class=MsgspecJSONResponse)
+async def query_path(object_id: int, path: str, db: AsyncSession = Depends(get_async_db)):
     try:
-        # fetch subtree starting from object_id and path
-        query_subtree = """
-            WITH RECURSIVE object_hierarchy AS (
-                SELECT 
-                    o.id,
-                    o.name,
-                    o.type,
-                    o.parent_id,
-                    o.location_details
-                FROM public."object" o
-                WHERE o.id = :object_id
-                UNION ALL
-                SELECT 
-                    o.id,
-                    o.name,
-                    o.type,
-                    o.parent_id,
-                    o.location_details FROM public."object" o
-                INNER JOIN object_hierarchy oh ON o.parent_id = oh.id
-            )
-            SELECT 
-                oh.id,
-                oh.name,
-                oh.type,
-                oh.parent_id,
-                oh.location_details,
-                d.id as datapoint_id,
-                d.name as datapoint_name,
-                d.type as datapoint_type,
-                d.value,
-                d.unit,
-                d.is_fresh,
-                d.created_at,
-                d.updated_at
-            FROM object_hierarchy oh
-            LEFT JOIN public.object_datapoint od ON oh.id = od."object_FK"
-            LEFT JOIN public.datapoint d ON od."datapoint_FK" = d.id
-            ORDER BY oh.id;
-        """
-        subtree_res = db.execute(text(query_subtree), {"object_id": object_id})
-        objects = [dict(row) for row in subtree_res.mappings()]
-        if not objects:
+        plan = compile_path(path)
+
+        await hierarchy_cache.ensure_loaded_async(db)
+        if object_id not in hierarchy_cache:
             raise HTTPException(status_code=404, detail=f"Object with id {object_id} not found")
 
-        subtree = build_subtree_with_datapoints(objects, object_id)
-        objects_with_datapoint = resolve_relative_path(subtree[0], path)
+        if plan.has_descendant_steps:
+            # '**' can match at any depth: fetch the whole subtree and resolve the path in Python
+            subtree_res = await db.execute(closure.QUERY_SUBTREE_WITH_DATAPOINTS, {"object_id": object_id})
+            objects = [dict(row) for row in subtree_res.mappings()]
+            with measure("build"):
+                subtree = build_subtree_with_datapoints(objects, object_id)
+                objects_with_datapoint = execute_path(plan, subtree[0]) if subtree else None
+            if not subtree:
+                raise HTTPException(status_code=404, detail=f"Object with id {object_id} not found")
+        else:
+            # the CTE follows the path steps and only returns the matching datapoints
+            path_res = await db.execute(QUERY_PATH_PRUNED, sql_params(plan, object_id))
+            objects_with_datapoint = collect_path_rows(path_res.mappings())
+
+        if write_behind.enabled:
+            for _node in objects_with_datapoint:
+                _node['datapoints'] = [write_behind.overlay(_datapoint) for _datapoint in _node['datapoints']]
 
         # get full tree, but with only the datapoints in path
-        _query_all_objects = """SELECT
-            id,
-            name,
-            type,
-            parent_id
-        FROM public."object"
-        ORDER BY
-            CASE WHEN parent_id IS NULL THEN 0 ELSE 1 END,
-            parent_id,
-            id;
-        """
-        objects_result = db.execute(text(_query_all_objects))
-        objects = [dict(row) for row in objects_result.mappings()]
-        full_tree = build_tree_with_node_datapoints(objects, nodes_with_datapoints=objects_with_datapoint)
-        return full_tree
+        with measure("build"):
+            full_tree = build_tree_structs_with_node_datapoints(
+                hierarchy_cache.children_index(), nodes_with_datapoints=objects_with_datapoint
+            )
+        with measure("serialize"):
+            return MsgspecJSONResponse(full_tree)
 
     except HTTPException:
         raise
+    except PathSyntaxError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
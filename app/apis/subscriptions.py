@@ -0,0 +1,70 @@
+import asyncio
+from typing import Optional
+
+from fastapi import APIRouter, HTTPException, Query
+from fastapi.responses import StreamingResponse
+
+from app.database import AsyncSessionLocal
+from app.hierarchy_cache import hierarchy_cache
+from app.path_query import PathSyntaxError, compile_path
+from app.subscriptions import SUBSCRIPTIONS_ENABLED, Subscription, dispatcher
+
+router = APIRouter(prefix="/api/subscriptions")
+
+HEARTBEAT_SECONDS = 15
+
+
+async def _events(subscription: Subscription):
+    dispatcher.subscribe(subscription)
+    try:
+        yield b": subscribed\n\n"
+        while True:
+            if subscription.overflowed:
+                yield b"event: overflow\ndata: {}\n\n"
+                return
+            try:
+                message = await asyncio.wait_for(subscription.queue.get(), timeout=HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                yield b": keep-alive\n\n"
+                continue
+            yield b"event: datapoint\ndata: " + message + b"\n\n"
+    finally:
+        dispatcher.unsubscribe(subscription)
+
+
+@router.get("/datapoints")
+async def subscribe_datapoint_changes(
+        object_id: int = Query(..., description="Stream the changes of datapoints of this object and its descendants"),
+        path: Optional[str] = Query(None, description="Only datapoints matched by this path expression from the object"),
+        datapoint_type: Optional[str] = Query(None, alias="type", description="Only datapoints of this type"),
+):
+    """Server-sent events stream of datapoint value changes below an object.
+
+    Each change is a `datapoint` event whose data is the datapoint as JSON, with its `object_id`.
+    A client that falls too far behind receives an `overflow` event and the stream ends; it should
+    reload the current values and subscribe again.
+    """
+    if not SUBSCRIPTIONS_ENABLED:
+        raise HTTPException(status_code=503, detail="Subscriptions are disabled, set DATAPOINT_SUBSCRIPTIONS=true")
+
+    try:
+        plan = compile_path(path) if path else None
+    except PathSyntaxError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    # a short-lived session: a request-scoped one would hold its connection for the whole stream
+    async with AsyncSessionLocal() as db:
+        await hierarchy_cache.ensure_loaded_async(db)
+    if object_id not in hierarchy_cache:
+        raise HTTPException(status_code=404, detail=f"Object with id {object_id} not found")
+
+    if plan is not None and plan.datapoint_step.type is not None:
+        if datapoint_type and datapoint_type.lower() != plan.datapoint_step.type:
+            raise HTTPException(status_code=400, detail="type does not match the last step of path")
+        datapoint_type = plan.datapoint_step.type
+
+    return StreamingResponse(
+        _events(Subscription(object_id, datapoint_type, plan)),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
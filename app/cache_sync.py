@@ -0,0 +1,161 @@
+# Cross-worker coherence of the in-process caches
+#
+# Every worker process has its own hierarchy cache and change tokens. With several workers (see
+# gunicorn.conf.py) the writes served by one must reach the others, over Postgres LISTEN/NOTIFY:
+# - object writes queue a NOTIFY with the object in their transaction, so every worker receives
+#   the changes in commit order and patches its hierarchy cache the same way the writer did;
+# - datapoint writes only need the other workers to bump their datapoint token, whatever the
+#   order, so bumps are sent after commit by a background task that coalesces bursts.
+# A worker whose listener connection drops may miss changes: on reconnect it marks its hierarchy
+# stale (reloaded by the next reader) and bumps its datapoint token.
+import asyncio
+import json
+import logging
+import os
+import secrets
+
+import asyncpg
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.change_tokens import change_tokens
+from app.database import ASYNCPG_DSN, env_flag
+from app.hierarchy_cache import HIERARCHY_FIELDS, hierarchy_cache
+
+logger = logging.getLogger(__name__)
+
+CACHE_SYNC_ENABLED = env_flag("CACHE_SYNC", False)
+CHANNEL = "cache_sync"
+RECONNECT_DELAY = 2.0
+
+NOTIFY = text("SELECT pg_notify(:channel, :payload)")
+
+
+_worker_id = None
+_worker_pid = None
+
+
+def worker_id() -> str:
+    """Id of this worker process in the notifications: a worker skips its own, it has applied them already.
+
+    Drawn per process, with gunicorn --preload the app is imported once, before the workers fork.
+    """
+    global _worker_id, _worker_pid
+    if _worker_pid != os.getpid():
+        _worker_pid = os.getpid()
+        _worker_id = f"{_worker_pid}-{secrets.token_hex(4)}"
+    return _worker_id
+
+
+async def _notify(db: AsyncSession, message: dict):
+    await db.execute(NOTIFY, {"channel": CHANNEL, "payload": json.dumps({"worker": worker_id(), **message})})
+
+
+async def publish_object_upsert(db: AsyncSession, obj):
+    """Queues the new state of an object for the other workers, sent when the caller's transaction commits
+    """
+    if CACHE_SYNC_ENABLED:
+        await _notify(db, {"op": "upsert", "object": {field: getattr(obj, field) for field in HIERARCHY_FIELDS}})
+
+
+async def publish_object_removal(db: AsyncSession, object_id: int):
+    if CACHE_SYNC_ENABLED:
+        await _notify(db, {"op": "remove", "id": object_id})
+
+
+class CacheSync:
+    def __init__(self):
+        self._loop = None
+        self._datapoints_changed = None
+        self.listening = asyncio.Event()  # set while the LISTEN connection is up
+        self.connections = 0
+        self.sent = 0
+        self.received = 0
+
+    def _on_datapoints_bump(self):
+        # change_tokens listener, may be called from a threadpool thread
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._datapoints_changed.set)
+
+    def _on_notification(self, connection, pid, channel, payload):
+        try:
+            message = json.loads(payload)
+        except ValueError:
+            logger.warning("Ignoring malformed cache notification")
+            return
+        if message.get("worker") == worker_id():
+            return
+        self.received += 1
+        op = message.get("op")
+        if op == "datapoints":
+            change_tokens.bump_datapoints(notify=False)
+        elif op == "upsert":
+            hierarchy_cache.upsert(message["object"])
+        elif op == "remove":
+            hierarchy_cache.remove(message["id"])
+
+    async def _publish_datapoint_bumps(self, connection, lost: asyncio.Event):
+        while not lost.is_set():
+            changed = asyncio.ensure_future(self._datapoints_changed.wait())
+            connection_lost = asyncio.ensure_future(lost.wait())
+            try:
+                await asyncio.wait((changed, connection_lost), return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                changed.cancel()
+                connection_lost.cancel()
+            if self._datapoints_changed.is_set():
+                # every bump made until now is covered by this one notification
+                self._datapoints_changed.clear()
+                await connection.execute(
+                    "SELECT pg_notify($1, $2)", CHANNEL, json.dumps({"worker": worker_id(), "op": "datapoints"})
+                )
+                self.sent += 1
+
+    async def run(self):
+        """Background loop of the app lifespan: LISTEN for the other workers' changes and send ours
+        """
+        self._loop = asyncio.get_running_loop()
+        self._datapoints_changed = asyncio.Event()
+        change_tokens.listeners.append(self._on_datapoints_bump)
+        try:
+            while True:
+                connection = None
+                try:
+                    connection = await asyncpg.connect(ASYNCPG_DSN)
+                    lost = asyncio.Event()
+                    connection.add_termination_listener(lambda _connection: lost.set())
+                    await connection.add_listener(CHANNEL, self._on_notification)
+                    if self.connections:
+                        # changes sent while we were not listening are lost
+                        hierarchy_cache.invalidate()
+                        change_tokens.bump_datapoints(notify=False)
+                    self.connections += 1
+                    self.listening.set()
+                    logger.info("Cache sync listening as worker %s", worker_id())
+                    await self._publish_datapoint_bumps(connection, lost)
+                    logger.warning("Cache sync connection lost, reconnecting")
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    logger.exception("Cache sync failed, reconnecting")
+                finally:
+                    self.listening.clear()
+                    if connection is not None and not connection.is_closed():
+                        await connection.close()
+                await asyncio.sleep(RECONNECT_DELAY)
+        finally:
+            change_tokens.listeners.remove(self._on_datapoints_bump)
+            self._loop = None
+
+    def snapshot(self):
+        return {
+            "enabled": CACHE_SYNC_ENABLED,
+            "worker_id": worker_id(),
+            "connections": self.connections,
+            "notifications_sent": self.sent,
+            "notifications_received": self.received,
+            "hierarchy_version": hierarchy_cache.version,
+        }
+
+
+cache_sync = CacheSync()
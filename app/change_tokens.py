@@ -0,0 +1,56 @@
+# Change tokens behind the ETags of the polled read endpoints
+import os
+import secrets
+import threading
+from typing import Optional
+
+
+class ChangeTokens:
+    """Counters the writers bump after their transaction commits.
+
+    The hierarchy token is `hierarchy_cache.version`; datapoint values, freshness and associations
+    share the `datapoints` counter, bumped by the datapoint endpoints, write-behind and the sweeper.
+    Readers take the tokens before querying, so a response is never tagged newer than its data.
+    Counters are per process: `epoch` keeps ETags of another worker or an earlier run from matching,
+    and app/cache_sync.py bumps the counter of every worker when one of them sees a write.
+    """
+
+    def __init__(self):
+        self._epoch = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self.datapoints = 0
+        self.listeners = []  # called on every local bump, app/cache_sync.py forwards them to the other workers
+
+    @property
+    def epoch(self) -> str:
+        # drawn per process: with gunicorn --preload the app is imported once, before the workers fork
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._epoch = secrets.token_hex(4)
+        return self._epoch
+
+    def bump_datapoints(self, notify: bool = True):
+        """`notify` False for bumps received from another worker, which must not be sent back
+        """
+        with self._lock:
+            self.datapoints += 1
+        if notify:
+            for listener in self.listeners:
+                listener()
+
+    def etag(self, *parts) -> str:
+        return '"' + '-'.join([self.epoch, *map(str, parts)]) + '"'
+
+
+change_tokens = ChangeTokens()
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Weak comparison of an If-None-Match header against an ETag (RFC 9110, 13.1.2)
+    """
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return any(candidate.strip().removeprefix("W/") == etag for candidate in if_none_match.split(","))
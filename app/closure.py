@@ -0,0 +1,192 @@
+# Maintenance and lookups of the object_closure table (migrations/0003_object_closure.sql)
+#
+# Every statement runs in the caller's transaction, next to the object write it mirrors.
+# Deletes need nothing here: closure rows cascade with the deleted objects.
+import sys
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+INSERT_OBJECT_PATHS = text("""
+    INSERT INTO object_closure (ancestor_id, descendant_id, depth)
+    SELECT ancestor_id, CAST(:object_id AS integer), depth + 1
+    FROM object_closure
+    WHERE descendant_id = CAST(:parent_id AS integer)
+    UNION ALL
+    SELECT CAST(:object_id AS integer), CAST(:object_id AS integer), 0;
+""")
+
+# drop the paths from the old ancestors into the moved subtree...
+DETACH_SUBTREE = text("""
+    DELETE FROM object_closure
+    WHERE descendant_id IN (SELECT descendant_id FROM object_closure WHERE ancestor_id = :object_id)
+      AND ancestor_id NOT IN (SELECT descendant_id FROM object_closure WHERE ancestor_id = :object_id);
+""")
+
+# ...and connect every ancestor of the new parent to every node of the subtree
+ATTACH_SUBTREE = text("""
+    INSERT INTO object_closure (ancestor_id, descendant_id, depth)
+    SELECT parent_paths.ancestor_id, subtree.descendant_id, parent_paths.depth + subtree.depth + 1
+    FROM object_closure parent_paths
+    CROSS JOIN object_closure subtree
+    WHERE parent_paths.descendant_id = :parent_id
+      AND subtree.ancestor_id = :object_id;
+""")
+
+QUERY_IS_DESCENDANT = text("""
+    SELECT 1 FROM object_closure WHERE ancestor_id = :ancestor_id AND descendant_id = :descendant_id;
+""")
+
+# every object below :object_id (inclusive) with its datapoints, in one indexed lookup
+QUERY_SUBTREE_WITH_DATAPOINTS = text("""
+    SELECT
+        o.id,
+        o.name,
+        o.type,
+        o.parent_id,
+        o.location_details,
+        d.id as datapoint_id,
+        d.name as datapoint_name,
+        d.type as datapoint_type,
+        d.value,
+        d.unit,
+        d.is_fresh,
+        d.created_at,
+        d.updated_at
+    FROM object_closure c
+    INNER JOIN public."object" o ON o.id = c.descendant_id
+    LEFT JOIN public.object_datapoint od ON o.id = od."object_FK"
+    LEFT JOIN public.datapoint d ON od."datapoint_FK" = d.id
+    WHERE c.ancestor_id = :object_id
+    ORDER BY o.id;
+""")
+
+# levels 1..:depth below an object (all levels if :depth is NULL), with the number of children of each
+QUERY_TREE_LEVELS = text("""
+    SELECT
+        o.id,
+        o.name,
+        o.type,
+        o.parent_id,
+        (SELECT count(*) FROM public."object" child WHERE child.parent_id = o.id) AS child_count
+    FROM object_closure c
+    INNER JOIN public."object" o ON o.id = c.descendant_id
+    WHERE c.ancestor_id = :parent_id
+      AND c.depth >= 1
+      AND (CAST(:depth AS integer) IS NULL OR c.depth <= CAST(:depth AS integer))
+    ORDER BY o.id;
+""")
+
+# the same for the top-level objects, which count as level 1
+QUERY_TOP_TREE_LEVELS = text("""
+    SELECT
+        o.id,
+        o.name,
+        o.type,
+        o.parent_id,
+        (SELECT count(*) FROM public."object" child WHERE child.parent_id = o.id) AS child_count
+    FROM public."object" top_level
+    INNER JOIN object_closure c ON c.ancestor_id = top_level.id
+    INNER JOIN public."object" o ON o.id = c.descendant_id
+    WHERE top_level.parent_id IS NULL
+      AND (CAST(:depth AS integer) IS NULL OR c.depth < CAST(:depth AS integer))
+    ORDER BY o.id;
+""")
+
+QUERY_OBJECT_EXISTS = text("""
+    SELECT 1 FROM public."object" WHERE id = :object_id;
+""")
+
+QUERY_TABLE_EXISTS = text("""
+    SELECT to_regclass('object_closure') IS NOT NULL;
+""")
+
+# objects without any closure row: the table was created but never backfilled
+QUERY_NOT_BACKFILLED = text("""
+    SELECT EXISTS (SELECT 1 FROM public."object") AND NOT EXISTS (SELECT 1 FROM object_closure);
+""")
+
+BACKFILL = [
+    text("TRUNCATE object_closure;"),
+    text("""
+        INSERT INTO object_closure (ancestor_id, descendant_id, depth)
+        WITH RECURSIVE paths AS (
+            SELECT id AS ancestor_id, id AS descendant_id, 0 AS depth
+            FROM public."object"
+            UNION ALL
+            SELECT p.ancestor_id, o.id, p.depth + 1
+            FROM paths p
+            JOIN public."object" o ON o.parent_id = p.descendant_id
+        )
+        SELECT ancestor_id, descendant_id, depth FROM paths;
+    """),
+]
+
+
+class ClosureTableMissing(RuntimeError):
+    """object_closure is missing or empty: the app cannot serve the hierarchy endpoints without it
+    """
+
+
+async def check_table(db: AsyncSession):
+    """Raises ClosureTableMissing unless migrations/0003_object_closure.sql is applied and backfilled
+    """
+    if not (await db.execute(QUERY_TABLE_EXISTS)).scalar():
+        raise ClosureTableMissing(
+            "object_closure does not exist: apply migrations/0003_object_closure.sql, "
+            "then run `python -m app.closure backfill`"
+        )
+    if (await db.execute(QUERY_NOT_BACKFILLED)).scalar():
+        raise ClosureTableMissing("object_closure is empty: run `python -m app.closure backfill`")
+
+
+async def add_object(db: AsyncSession, object_id: int, parent_id):
+    """Adds the paths of a new leaf object; the object row must already be flushed
+    """
+    await db.execute(INSERT_OBJECT_PATHS, {"object_id": object_id, "parent_id": parent_id})
+
+
+async def move_subtree(db: AsyncSession, object_id: int, parent_id):
+    """Re-parents an object and its descendants, `parent_id` None makes it a root
+    """
+    await db.execute(DETACH_SUBTREE, {"object_id": object_id})
+    if parent_id is not None:
+        await db.execute(ATTACH_SUBTREE, {"object_id": object_id, "parent_id": parent_id})
+
+
+async def is_descendant(db: AsyncSession, ancestor_id: int, descendant_id: int) -> bool:
+    result = await db.execute(QUERY_IS_DESCENDANT, {"ancestor_id": ancestor_id, "descendant_id": descendant_id})
+    return result.first() is not None
+
+
+def tree_levels(db: Session, parent_id, depth):
+    """Rows (with child_count) of the objects up to `depth` levels below `parent_id`, None the top level.
+
+    Sync, for GET /api/objects/tree while the hierarchy cache is not loaded. Returns None if
+    `parent_id` does not exist.
+    """
+    if parent_id is None:
+        result = db.execute(QUERY_TOP_TREE_LEVELS, {"depth": depth})
+    else:
+        result = db.execute(QUERY_TREE_LEVELS, {"parent_id": parent_id, "depth": depth})
+    rows = [dict(row) for row in result.mappings()]
+    if not rows and parent_id is not None and db.execute(QUERY_OBJECT_EXISTS, {"object_id": parent_id}).first() is None:
+        return None
+    return rows
+
+
+def backfill(engine):
+    """Rebuilds object_closure from object.parent_id in one transaction
+    """
+    with engine.begin() as conn:
+        for statement in BACKFILL:
+            conn.execute(statement)
+        return conn.execute(text("SELECT count(*) FROM object_closure")).scalar()
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["backfill"]:
+        sys.exit("usage: python -m app.closure backfill")
+    from app.database import engine
+    print(f"object_closure rebuilt with {backfill(engine)} rows")
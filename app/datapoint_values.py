@@ -0,0 +1,104 @@
+# Set-based writes of datapoint values, shared by the value update endpoints
+from datetime import datetime
+from typing import Dict, Iterable, Optional, Tuple
+
+from sqlalchemy import Boolean, DateTime, Integer, Text, and_, case, cast, column, func, null, or_, update, values
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.freshness import FRESHNESS_ENABLED, fresh_until_expr, touch_associations
+from app.history import record_history
+from app.models.sql_alchemy_models import Datapoint
+from app.subscriptions import publish_changes
+
+
+def coalesce_updates(updates: Iterable[Tuple[int, Optional[str], Optional[bool]]]) -> Dict[int, Tuple[Optional[str], Optional[bool]]]:
+    """Keeps one update per datapoint id, the last one wins
+    """
+    return {datapoint_id: (value, is_fresh) for datapoint_id, value, is_fresh in updates}
+
+
+def values_update_statement(updates: Dict[int, Tuple[Optional[str], Optional[bool]]],
+                            received_at: Optional[Dict[int, datetime]] = None, own_write_at: Optional[datetime] = None,
+                            stamp_value_writes: bool = False):
+    """The UPDATE ... FROM (VALUES ...) statement for {id: (value, is_fresh)}.
+
+    A None value or is_fresh leaves that column unchanged. Rows that would not change are not
+    written, except that with freshness TTLs a new value (a reading) always renews `fresh_until`
+    and marks the datapoint fresh unless is_fresh is given. Returns id, value, is_fresh,
+    updated_at and the old value and is_fresh of every written row.
+
+    With `stamp_value_writes`, or `received_at`, rows given a value get `value_updated_at`. With
+    `received_at` ({id: when its update was received}) a value written after the update was received
+    wins over the update's value, and over its is_fresh with freshness TTLs (that write was a reading);
+    `own_write_at` is the transaction time of the writer's previous batch, whose values do not count
+    as later writes.
+    """
+    columns = [column("id", Integer), column("value", Text), column("is_fresh", Boolean)]
+    if received_at is not None:
+        columns.append(column("received_at", DateTime(timezone=True)))
+        rows = [(datapoint_id, value, is_fresh, received_at[datapoint_id])
+                for datapoint_id, (value, is_fresh) in updates.items()]
+    else:
+        rows = [(datapoint_id, value, is_fresh) for datapoint_id, (value, is_fresh) in updates.items()]
+    new_values = values(*columns, name="new_values").data(rows)
+    # second reference to the table: in RETURNING it still holds the values from before the update
+    old = Datapoint.__table__.alias("old_datapoint")
+
+    # NULLs are rendered as untyped literals, cast so an all-NULL column is not resolved as text
+    new_value = cast(new_values.c.value, Text)
+    new_is_fresh = cast(new_values.c.is_fresh, Boolean)
+    if received_at is not None:
+        # evaluated again on the latest row version when a concurrent write held the row
+        superseded = and_(
+            Datapoint.value_updated_at > cast(new_values.c.received_at, DateTime(timezone=True)),
+            Datapoint.value_updated_at.is_distinct_from(own_write_at),
+        )
+        new_value = case((superseded, null()), else_=new_value)
+        if FRESHNESS_ENABLED:
+            new_is_fresh = case((superseded, null()), else_=new_is_fresh)
+    value = func.coalesce(new_value, Datapoint.value)
+    assignments = {"value": value, "updated_at": func.now()}
+    if FRESHNESS_ENABLED:
+        is_reading = new_value.isnot(None)
+        is_fresh = func.coalesce(new_is_fresh, case((is_reading, True), else_=Datapoint.is_fresh))
+        assignments["fresh_until"] = case((is_reading, fresh_until_expr(Datapoint.type)), else_=Datapoint.fresh_until)
+        must_write = or_(Datapoint.value.is_distinct_from(value), Datapoint.is_fresh.is_distinct_from(is_fresh), is_reading)
+    else:
+        is_fresh = func.coalesce(new_is_fresh, Datapoint.is_fresh)
+        must_write = or_(Datapoint.value.is_distinct_from(value), Datapoint.is_fresh.is_distinct_from(is_fresh))
+    assignments["is_fresh"] = is_fresh
+    if stamp_value_writes or received_at is not None:
+        assignments["value_updated_at"] = case((new_value.isnot(None), func.now()), else_=Datapoint.value_updated_at)
+
+    return (
+        update(Datapoint)
+        .where(Datapoint.id == new_values.c.id)
+        .where(old.c.id == new_values.c.id)
+        .where(must_write)
+        .values(**assignments)
+        .returning(
+            Datapoint.id, Datapoint.value, Datapoint.is_fresh, Datapoint.updated_at,
+            old.c.value.label("old_value"), old.c.is_fresh.label("old_is_fresh")
+        )
+        .execution_options(synchronize_session=False)
+    )
+
+
+async def apply_datapoint_values(db: AsyncSession, updates: Dict[int, Tuple[Optional[str], Optional[bool]]],
+                                 received_at: Optional[Dict[int, datetime]] = None,
+                                 own_write_at: Optional[datetime] = None, stamp_value_writes: bool = False):
+    """Applies {id: (value, is_fresh)} with a single statement, see `values_update_statement`.
+
+    Value changes are recorded in the value history and published to subscribers. Returns (id, value, is_fresh, updated_at)
+    of the rows whose value or is_fresh changed. The caller commits.
+    """
+    if not updates:
+        return []
+
+    written = (await db.execute(values_update_statement(updates, received_at, own_write_at, stamp_value_writes))).all()
+
+    await touch_associations(db, [datapoint_id for datapoint_id, (value, _) in updates.items() if value is not None])
+    await record_history(db, [(row.id, row.value) for row in written if row.value != row.old_value])
+    changed = [row for row in written if row.value != row.old_value or row.is_fresh != row.old_is_fresh]
+    await publish_changes(db, [row.id for row in changed])
+    return changed
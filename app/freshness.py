@@ -0,0 +1,121 @@
+# Server-driven datapoint freshness: per-type TTLs and the staleness sweeper
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Optional
+
+from sqlalchemy import case, func, literal, literal_column, text, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.change_tokens import change_tokens
+from app.database import AsyncSessionLocal
+from app.models.sql_alchemy_models import ObjectDatapoint
+from app.subscriptions import publish_changes
+
+logger = logging.getLogger(__name__)
+
+
+def parse_ttls(raw: str) -> Dict[str, int]:
+    """Parses `temperature=300,humidity=900` into {type: seconds}
+    """
+    ttls = {}
+    for item in filter(None, (part.strip() for part in raw.split(','))):
+        datapoint_type, _, seconds = item.partition('=')
+        ttls[datapoint_type.strip().lower()] = int(seconds)
+    return ttls
+
+
+FRESHNESS_TTLS = parse_ttls(os.getenv("DATAPOINT_FRESHNESS_TTLS", ""))
+DEFAULT_TTL = int(os.getenv("DATAPOINT_FRESHNESS_TTL_DEFAULT", 0))  # 0: datapoints never go stale
+SWEEP_INTERVAL = float(os.getenv("DATAPOINT_FRESHNESS_SWEEP_INTERVAL", 5))
+SWEEP_BATCH = 5000
+
+FRESHNESS_ENABLED = DEFAULT_TTL > 0 or any(seconds > 0 for seconds in FRESHNESS_TTLS.values())
+
+# Uses the partial index ix_datapoint_fresh_until (migrations/0002_datapoint_freshness.sql), so each
+# sweep only reads the datapoints whose TTL has passed. SKIP LOCKED lets several workers sweep at once.
+SWEEP_STALE_DATAPOINTS = text("""
+    UPDATE datapoint
+    SET is_fresh = false
+    WHERE id IN (
+        SELECT id
+        FROM datapoint
+        WHERE is_fresh AND fresh_until <= now()
+        ORDER BY fresh_until
+        LIMIT :batch
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING id;
+""")
+
+
+def ttl_for(datapoint_type: Optional[str]) -> int:
+    return FRESHNESS_TTLS.get((datapoint_type or '').lower(), DEFAULT_TTL)
+
+
+def fresh_until_for(datapoint_type: Optional[str], now: datetime = None) -> Optional[datetime]:
+    """Expiry of a reading taken now, None when the type never goes stale
+    """
+    ttl = ttl_for(datapoint_type)
+    if ttl <= 0:
+        return None
+    return (now or datetime.now(timezone.utc)) + timedelta(seconds=ttl)
+
+
+def fresh_until_expr(type_column):
+    """SQL expression for the expiry of a reading taken now, based on the row's type
+    """
+    if FRESHNESS_TTLS:
+        ttl_seconds = case(FRESHNESS_TTLS, value=func.lower(type_column), else_=DEFAULT_TTL)
+    else:
+        ttl_seconds = literal(DEFAULT_TTL)
+    return case(
+        (ttl_seconds > 0, func.now() + ttl_seconds * literal_column("interval '1 second'")),
+        else_=None
+    )
+
+
+async def touch_associations(db: AsyncSession, datapoint_ids):
+    """Sets object_datapoint.last_updated for datapoints that just received a value
+    """
+    datapoint_ids = list(datapoint_ids)
+    if not datapoint_ids:
+        return
+    await db.execute(
+        update(ObjectDatapoint)
+        .where(ObjectDatapoint.datapoint_FK.in_(datapoint_ids))
+        .values(last_updated=func.now())
+        .execution_options(synchronize_session=False)
+    )
+
+
+async def sweep_stale():
+    """Marks datapoints whose TTL has passed as not fresh, returns their ids.
+
+    Like any other write of is_fresh, each batch is published to subscribers and bumps the change token.
+    """
+    expired = []
+    while True:
+        async with AsyncSessionLocal() as db:
+            ids = list((await db.execute(SWEEP_STALE_DATAPOINTS, {"batch": SWEEP_BATCH})).scalars())
+            await publish_changes(db, ids)
+            await db.commit()
+        if ids:
+            change_tokens.bump_datapoints()
+        expired.extend(ids)
+        if len(ids) < SWEEP_BATCH:
+            return expired
+
+
+async def run_sweeper():
+    """Background loop of the app lifespan
+    """
+    while True:
+        try:
+            expired = await sweep_stale()
+            if expired:
+                logger.debug("Marked %d datapoints as stale", len(expired))
+        except Exception:
+            logger.exception("Freshness sweep failed")
+        await asyncio.sleep(SWEEP_INTERVAL)
@@ -0,0 +1,291 @@
+# In-memory copy of the object hierarchy (id, name, type, parent_id)
+import threading
+from bisect import insort
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Tuple
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from app.responses import encode_json
+from app.utils import build_tree_structs
+
+QUERY_ALL_OBJECTS = text("""SELECT
+    id,
+    name,
+    type,
+    parent_id
+FROM public."object"
+ORDER BY
+    CASE WHEN parent_id IS NULL THEN 0 ELSE 1 END,
+    parent_id,
+    id;
+""")
+
+HIERARCHY_FIELDS = ('id', 'name', 'type', 'parent_id')
+# lock-free attempts at building a view before building it under the lock
+OPTIMISTIC_READS = 3
+
+
+class _ChildObjects:
+    """parent_id -> child objects, looked up on demand from the id lists of the cache
+    """
+
+    def __init__(self, objects, children):
+        self._objects = objects
+        self._children = children
+
+    def get(self, parent_id, default=()):
+        child_ids = self._children.get(parent_id)
+        if not child_ids:
+            return default
+        return [self._objects[_id] for _id in child_ids]
+
+
+def _index(rows):
+    """(id -> object, parent_id -> sorted child ids) of hierarchy rows
+    """
+    objects = {}
+    children = defaultdict(list)
+    for row in rows:
+        obj = {field: row[field] for field in HIERARCHY_FIELDS}
+        objects[obj['id']] = obj
+        children[obj['parent_id']].append(obj['id'])
+    for child_ids in children.values():
+        child_ids.sort()
+    return objects, children
+
+
+class HierarchyCache:
+    """Process-local index of the object hierarchy.
+
+    The hierarchy is loaded from the database once, then kept up to date by the object
+    write endpoints through `upsert` and `remove` after their transaction commits, and by
+    app/cache_sync.py for the writes served by other worker processes.
+    Every change bumps `version`; derived views (ordered objects, tree) are rebuilt lazily
+    the first time they are read at a new version.
+
+    The lock only covers the patches and snapshot swaps. Views are built without it: the
+    ones read from the indexes are redone when a patch overlapped them (seen by `_seq`),
+    the tree and its JSON are built from the children index view, which is never patched.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._objects = None  # id -> {'id', 'name', 'type', 'parent_id'}
+        self._children = None  # parent_id -> sorted list of child ids
+        self._views = {}
+        self._stale = False
+        self._seq = 0  # odd while the data is being changed
+        self.version = 0
+
+    @property
+    def loaded(self) -> bool:
+        return self._objects is not None and not self._stale
+
+    def load(self, rows):
+        """Replaces the cached hierarchy with `rows`
+        """
+        self._install(*_index(rows))
+
+    def ensure_loaded(self, db: Session):
+        """Loads the hierarchy from the database if it is not in memory yet.
+
+        The query and the indexing run without the lock, the event loop patches the cache under
+        it; a snapshot is only installed if no write-through patch was applied (and dropped)
+        while it was being read.
+        """
+        while not self.loaded:
+            version = self.version
+            self._install(*_index(db.execute(QUERY_ALL_OBJECTS).mappings()), version=version)
+
+    async def ensure_loaded_async(self, db: AsyncSession):
+        """Async variant of ensure_loaded
+        """
+        while not self.loaded:
+            version = self.version
+            rows = (await db.execute(QUERY_ALL_OBJECTS)).mappings().all()
+            self._install(*_index(rows), version=version)
+
+    def _install(self, objects, children, version=None):
+        """Swaps in an indexed snapshot, unless `version` is given and the cache moved past it
+        """
+        with self._writing():
+            if version is not None and (self.loaded or self.version != version):
+                return
+            self._objects = objects
+            self._children = children
+            self._stale = False
+            self._bump()
+
+    def invalidate(self):
+        """Marks the cached hierarchy stale, the next ensure_loaded reloads it from the database.
+
+        The previous snapshot stays in place until then: a reader that passed ensure_loaded just
+        before never finds the hierarchy gone, it reads the old one.
+        """
+        with self._lock:
+            self._stale = True
+            self._bump()
+
+    def upsert(self, obj):
+        """Adds or updates one object, `obj` can be an ORM instance or a mapping
+        """
+        if not isinstance(obj, dict):
+            obj = {field: getattr(obj, field) for field in HIERARCHY_FIELDS}
+        with self._writing():
+            if not self.loaded:
+                self._bump()
+                return
+            obj = {field: obj[field] for field in HIERARCHY_FIELDS}
+            previous = self._objects.get(obj['id'])
+            if previous is not None and previous['parent_id'] != obj['parent_id']:
+                self._children[previous['parent_id']].remove(obj['id'])
+            if previous is None or previous['parent_id'] != obj['parent_id']:
+                insort(self._children[obj['parent_id']], obj['id'])
+            self._objects[obj['id']] = obj
+            self._bump()
+
+    def remove(self, object_id: int):
+        """Removes an object and its descendants, mirroring the ON DELETE CASCADE of object.parent_id
+        """
+        with self._writing():
+            if not self.loaded:
+                self._bump()
+                return
+            if object_id not in self._objects:
+                return
+            parent_id = self._objects[object_id]['parent_id']
+            self._children[parent_id].remove(object_id)
+            stack = [object_id]
+            while stack:
+                _id = stack.pop()
+                del self._objects[_id]
+                stack.extend(self._children.pop(_id, ()))
+            self._bump()
+
+    def get(self, object_id: int):
+        objects = self._objects
+        return objects.get(object_id) if objects is not None else None
+
+    def __contains__(self, object_id) -> bool:
+        objects = self._objects
+        return objects is not None and object_id in objects
+
+    def children(self, object_id):
+        return [self._objects[_id] for _id in self._children.get(object_id, ())]
+
+    def objects(self):
+        """All objects ordered by id, which gives the same sibling order as QUERY_ALL_OBJECTS
+        """
+        return self._live_view('objects', lambda: sorted(self._objects.values(), key=lambda obj: obj['id']))[1]
+
+    def children_index(self):
+        """parent_id -> list of child objects, ordered by id
+        """
+        return self._children_index()[1]
+
+    def tree(self):
+        """The full hierarchy as TreeNode structs. Shared, do not mutate.
+        """
+        return self._tree()[1]
+
+    def subtree(self, parent_id=None, depth=None):
+        """(version, TreeNode structs) of the objects up to `depth` levels below `parent_id`.
+
+        Built on each call from the child id lists, so the work is bounded by the nodes returned,
+        without the lock (see _read). Returns None if the hierarchy is not loaded, raises KeyError for an unknown `parent_id`.
+        """
+        def build():
+            if not self.loaded:
+                return None
+            if parent_id is not None and parent_id not in self._objects:
+                raise KeyError(parent_id)
+            return build_tree_structs(_ChildObjects(self._objects, self._children), parent_id, depth)
+
+        version, tree = self._read(build)
+        return (version, tree) if tree is not None else None
+
+    def tree_json(self) -> Tuple[int, bytes]:
+        """(version, body) of GET /api/objects/tree, the body is encoded once per version
+        """
+        return self._derived_view('tree_json', self._tree, encode_json)
+
+    def _children_index(self):
+        return self._live_view('children_index', lambda: {
+            parent_id: [self._objects[_id] for _id in child_ids]
+            for parent_id, child_ids in self._children.items()
+        })
+
+    def _tree(self):
+        return self._derived_view('tree', self._children_index, build_tree_structs)
+
+    def _cached_view(self, name):
+        version, value = self._views.get(name, (None, None))
+        return (version, value) if version == self.version else None
+
+    def _store_view(self, name, version, value):
+        with self._lock:
+            if version == self.version:
+                self._views[name] = (version, value)
+
+    def _live_view(self, name, build):
+        """(version, value) of a view read from the indexes, see _read
+        """
+        cached = self._cached_view(name)
+        if cached is not None:
+            return cached
+        version, value = self._read(build)
+        self._store_view(name, version, value)
+        return version, value
+
+    def _derived_view(self, name, source, build):
+        """(version, value) of a view built from another view's value, which patches never touch:
+        the build runs without the lock and needs no retry
+        """
+        cached = self._cached_view(name)
+        if cached is not None:
+            return cached
+        version, source_value = source()
+        value = build(source_value)
+        self._store_view(name, version, value)
+        return version, value
+
+    def _read(self, read):
+        """(version, read()) with `read` seeing a single version of the hierarchy.
+
+        `read` runs without the lock; when a patch overlapped it, its result (or error) is
+        dropped and it runs again, under the lock after OPTIMISTIC_READS attempts.
+        """
+        for _ in range(OPTIMISTIC_READS):
+            seq = self._seq
+            if seq % 2:
+                continue
+            version = self.version
+            try:
+                value = read()
+            except Exception:
+                if self._seq == seq:
+                    raise
+                continue
+            if self._seq == seq:
+                return version, value
+        with self._lock:
+            return self.version, read()
+
+    @contextmanager
+    def _writing(self):
+        with self._lock:
+            self._seq += 1
+            try:
+                yield
+            finally:
+                self._seq += 1
+
+    def _bump(self):
+        self.version += 1
+
+
+hierarchy_cache = HierarchyCache()
@@ -0,0 +1,171 @@
+# Datapoint value history: recording, range queries and partition maintenance
+import asyncio
+import logging
+import math
+import os
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import Connection, func, text
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.database import async_engine, env_flag
+from app.models.sql_alchemy_models import DatapointHistory
+
+logger = logging.getLogger(__name__)
+
+HISTORY_ENABLED = env_flag("DATAPOINT_HISTORY", False)
+RETENTION_DAYS = int(os.getenv("DATAPOINT_HISTORY_RETENTION_DAYS", 365))
+PARTITION_MONTHS_AHEAD = 2
+MAINTENANCE_INTERVAL = 6 * 3600
+# pg advisory lock key: one worker at a time runs the maintenance
+MAINTENANCE_LOCK_KEY = 7_250_001
+DEFAULT_PARTITION = "datapoint_history_default"
+
+QUERY_HISTORY_BUCKETS = text("""
+    SELECT
+        to_timestamp(floor(extract(epoch FROM ts) / CAST(:bucket_seconds AS double precision)) * :bucket_seconds) AS ts,
+        min(value_num) AS min,
+        max(value_num) AS max,
+        avg(value_num) AS avg,
+        (array_agg(coalesce(value_num::text, value_text) ORDER BY ts DESC))[1] AS last,
+        count(*) AS count
+    FROM datapoint_history
+    WHERE "datapoint_FK" = :datapoint_id
+      AND ts >= :start
+      AND ts < :end
+    GROUP BY 1
+    ORDER BY 1;
+""")
+
+QUERY_HISTORY_PARTITIONS = text("""
+    SELECT child.relname
+    FROM pg_inherits
+    JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+    JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+    WHERE parent.relname = 'datapoint_history';
+""")
+
+
+def split_value(value):
+    """Returns (value_num, value_text): numbers are stored as double precision, anything else as text
+    """
+    if value is None:
+        return None, None
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None, value
+    if math.isfinite(number):
+        return number, None
+    return None, value
+
+
+async def record_history(db: AsyncSession, values):
+    """Appends (datapoint_id, value) pairs at the transaction timestamp, in the caller's transaction
+    """
+    if not HISTORY_ENABLED:
+        return
+    # one row per datapoint and timestamp: a datapoint written twice in one transaction keeps its last value
+    latest = {datapoint_id: value for datapoint_id, value in values if value is not None}
+    if not latest:
+        return
+    rows = []
+    for datapoint_id, value in latest.items():
+        value_num, value_text = split_value(value)
+        rows.append({"datapoint_FK": datapoint_id, "value_num": value_num, "value_text": value_text})
+
+    stmt = insert(DatapointHistory.__table__).values(ts=func.now())
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[DatapointHistory.datapoint_FK, DatapointHistory.ts],
+        set_={"value_num": stmt.excluded.value_num, "value_text": stmt.excluded.value_text}
+    )
+    await db.execute(stmt, rows)
+
+
+def bucket_seconds_for(start: datetime, end: datetime, max_points: int) -> int:
+    return max(1, math.ceil((end - start).total_seconds() / max_points))
+
+
+async def query_history(db: AsyncSession, datapoint_id: int, start: datetime, end: datetime, bucket_seconds: int):
+    result = await db.execute(QUERY_HISTORY_BUCKETS, {
+        "datapoint_id": datapoint_id,
+        "start": start,
+        "end": end,
+        "bucket_seconds": bucket_seconds,
+    })
+    return result.mappings().all()
+
+
+def _month_start(moment: datetime) -> datetime:
+    return moment.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def _add_months(moment: datetime, months: int) -> datetime:
+    month_index = moment.month - 1 + months
+    return moment.replace(year=moment.year + month_index // 12, month=month_index % 12 + 1)
+
+
+def _partition_name(month: datetime) -> str:
+    return f"datapoint_history_{month:%Y%m}"
+
+
+def create_partitions(conn: Connection, first: datetime, last: datetime):
+    """Creates the monthly partitions from the month of `first` to that of `last`, in the caller's transaction.
+
+    A partition cannot be attached while the default partition holds rows in its range, so each new one is
+    created detached, the rows of its month are moved into it from the default partition, then it is attached.
+    """
+    month = _month_start(first)
+    while month <= last:
+        name = _partition_name(month)
+        if conn.execute(text("SELECT to_regclass(:name)"), {"name": name}).scalar() is None:
+            start, end = month.isoformat(), _add_months(month, 1).isoformat()
+            conn.execute(text(f"CREATE TABLE {name} (LIKE datapoint_history INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"))
+            moved = conn.execute(text(
+                f"WITH moved AS (DELETE FROM {DEFAULT_PARTITION} WHERE ts >= '{start}' AND ts < '{end}' RETURNING *) "
+                f"INSERT INTO {name} SELECT * FROM moved"
+            )).rowcount
+            conn.execute(text(f"ALTER TABLE datapoint_history ATTACH PARTITION {name} FOR VALUES FROM ('{start}') TO ('{end}')"))
+            logger.info("Created history partition %s, %d rows moved from the default partition", name, moved)
+        month = _add_months(month, 1)
+
+
+def drop_expired_partitions(conn: Connection, now: datetime):
+    cutoff = now - timedelta(days=RETENTION_DAYS)
+    for name in conn.execute(QUERY_HISTORY_PARTITIONS).scalars().all():
+        suffix = name.rsplit('_', 1)[-1]
+        if not (suffix.isdigit() and len(suffix) == 6):
+            continue  # default partition
+        month = datetime(int(suffix[:4]), int(suffix[4:]), 1, tzinfo=timezone.utc)
+        if _add_months(month, 1) <= cutoff:
+            logger.info("Dropping history partition %s (retention %d days)", name, RETENTION_DAYS)
+            conn.execute(text(f"DROP TABLE IF EXISTS {name}"))
+
+
+async def maintain_partitions(now: datetime = None):
+    """Creates the monthly partitions ahead of time and drops those past the retention period.
+
+    Returns False without doing anything while another worker holds the maintenance lock.
+    """
+    now = now or datetime.now(timezone.utc)
+    async with async_engine.begin() as conn:
+        # released with the transaction
+        locked = (await conn.execute(text("SELECT pg_try_advisory_xact_lock(:key)"), {"key": MAINTENANCE_LOCK_KEY})).scalar()
+        if not locked:
+            logger.debug("History partition maintenance is running in another worker")
+            return False
+        await conn.run_sync(create_partitions, now, _add_months(_month_start(now), PARTITION_MONTHS_AHEAD))
+        await conn.run_sync(drop_expired_partitions, now)
+    return True
+
+
+async def run_maintenance():
+    """Background loop of the app lifespan
+    """
+    while True:
+        try:
+            await maintain_partitions()
+        except Exception:
+            logger.exception("History partition maintenance failed")
+        await asyncio.sleep(MAINTENANCE_INTERVAL)
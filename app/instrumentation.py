@@ -0,0 +1,248 @@
+# Per-request instrumentation: SQL statements and time, Python build time, latency histograms
+#
+# Cursor events of both engines and `measure()` blocks add to the RequestStats of the request being
+# served, found through a context variable set by InstrumentationMiddleware. When the request ends its
+# totals go into per-route histograms, exposed in the Prometheus text format on GET /metrics.
+#
+# With DEBUG_QUERY_COUNT=true (read in main.py, app.database imports this module) every response
+# carries the statement count in an X-Query-Count header, so a handler that starts issuing one query
+# per row shows up at once. With SLOW_REQUEST_MS set, the requests slower than that are logged with
+# their statements and timings.
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+QUERY_COUNT_HEADER = b"x-query-count"
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", 0))  # 0 disables the slow request log
+SLOW_REQUEST_MAX_STATEMENTS = 50
+
+# upper bounds (seconds) of the histogram buckets
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# requests that matched no route share one label, so scanners cannot blow up the series count
+UNMATCHED_ROUTE = "unmatched"
+
+
+class RequestStats:
+    __slots__ = ("count", "sql_seconds", "phases", "statements")
+
+    def __init__(self, keep_statements: bool = False):
+        self.count = 0
+        self.sql_seconds = 0.0
+        self.phases = {}
+        self.statements = [] if keep_statements else None
+
+
+_current: ContextVar[Optional[RequestStats]] = ContextVar("request_stats", default=None)
+
+
+def current_query_count() -> Optional[int]:
+    """Queries issued so far by the current request, None outside of a request
+    """
+    stats = _current.get()
+    return stats.count if stats is not None else None
+
+
+@contextmanager
+def measure(phase: str):
+    """Adds the time spent in the block to the `phase` (e.g. "build", "serialize") of the current request
+    """
+    stats = _current.get()
+    if stats is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats.phases[phase] = stats.phases.get(phase, 0.0) + time.perf_counter() - start
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = _current.get()
+    if stats is not None:
+        stats.count += 1
+        # a connection runs one statement at a time, a failed one is overwritten by the next
+        conn.info["query_start"] = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = _current.get()
+    start = conn.info.pop("query_start", None)
+    if stats is None or start is None:
+        return
+    elapsed = time.perf_counter() - start
+    stats.sql_seconds += elapsed
+    if stats.statements is not None and len(stats.statements) < SLOW_REQUEST_MAX_STATEMENTS:
+        stats.statements.append((elapsed, " ".join(statement.split())[:500]))
+
+
+def instrument_engine(engine):
+    """Counts and times the statements of `engine` (the sync_engine of an AsyncEngine) per request
+    """
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+
+class Histogram:
+    def __init__(self, buckets=DURATION_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+def _labels(**labels):
+    return ",".join(f'{name}="{value}"' for name, value in labels.items())
+
+
+class RequestMetrics:
+    """Per-route request counters and histograms of this worker process
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = {}  # (method, route, status) -> count
+        self.durations = {}  # (method, route) -> Histogram
+        self.sql_durations = {}  # (method, route) -> Histogram
+        self.sql_queries = {}  # (method, route) -> count
+        self.phases = {}  # (method, route, phase) -> seconds
+
+    def record(self, method, route, status, seconds, stats: RequestStats):
+        key = (method, route)
+        with self._lock:
+            self.requests[(method, route, status)] = self.requests.get((method, route, status), 0) + 1
+            self.durations.setdefault(key, Histogram()).observe(seconds)
+            self.sql_durations.setdefault(key, Histogram()).observe(stats.sql_seconds)
+            self.sql_queries[key] = self.sql_queries.get(key, 0) + stats.count
+            for phase, phase_seconds in stats.phases.items():
+                self.phases[(method, route, phase)] = self.phases.get((method, route, phase), 0.0) + phase_seconds
+
+    @staticmethod
+    def _histogram_lines(name, histograms):
+        for (method, route), histogram in sorted(histograms.items()):
+            labels = _labels(method=method, route=route)
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+                cumulative += count
+                yield f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}'
+            yield f"{name}_sum{{{labels}}} {histogram.sum}"
+            yield f"{name}_count{{{labels}}} {cumulative}"
+
+    def render(self) -> str:
+        with self._lock:
+            lines = [
+                "# HELP http_requests_total Requests by route and status code.",
+                "# TYPE http_requests_total counter",
+            ]
+            for (method, route, status), count in sorted(self.requests.items()):
+                lines.append(f"http_requests_total{{{_labels(method=method, route=route, status=status)}}} {count}")
+            lines += [
+                "# HELP http_request_duration_seconds Request latency, until the response body is sent.",
+                "# TYPE http_request_duration_seconds histogram",
+                *self._histogram_lines("http_request_duration_seconds", self.durations),
+                "# HELP http_request_sql_duration_seconds SQL time spent per request.",
+                "# TYPE http_request_sql_duration_seconds histogram",
+                *self._histogram_lines("http_request_sql_duration_seconds", self.sql_durations),
+                "# HELP http_request_sql_queries_total SQL statements run by requests.",
+                "# TYPE http_request_sql_queries_total counter",
+            ]
+            for (method, route), count in sorted(self.sql_queries.items()):
+                lines.append(f"http_request_sql_queries_total{{{_labels(method=method, route=route)}}} {count}")
+            lines += [
+                "# HELP http_request_phase_seconds_total Python time spent building and serializing responses.",
+                "# TYPE http_request_phase_seconds_total counter",
+            ]
+            for (method, route, phase), seconds in sorted(self.phases.items()):
+                lines.append(
+                    f"http_request_phase_seconds_total{{{_labels(method=method, route=route, phase=phase)}}} {seconds}"
+                )
+        return "\n".join(lines) + "\n"
+
+
+request_metrics = RequestMetrics()
+
+
+_route_paths = {}  # endpoint function -> path template
+
+
+def _route_template(scope) -> str:
+    """The path template of the route that served the request, e.g. /api/objects/{object_id}
+    """
+    endpoint = scope.get("endpoint")
+    if endpoint is None:
+        return UNMATCHED_ROUTE
+    path = _route_paths.get(endpoint)
+    if path is None:
+        path = next(
+            (route.path for route in scope["app"].routes if getattr(route, "endpoint", None) is endpoint),
+            UNMATCHED_ROUTE
+        )
+        _route_paths[endpoint] = path
+    return path
+
+
+class InstrumentationMiddleware:
+    """ASGI middleware giving each HTTP request its own RequestStats and recording them when it ends.
+
+    The stats object is shared, not copied, with the tasks, threads and greenlets serving the
+    request, so their increments are all seen here. The X-Query-Count header reports the queries
+    issued until the response starts; a streamed body may issue more.
+    """
+
+    def __init__(self, app, header: bool = False, slow_request_ms: float = SLOW_REQUEST_MS,
+                 metrics: RequestMetrics = request_metrics, exclude_paths=("/metrics",)):
+        self.app = app
+        self.header = header
+        self.slow_request_ms = slow_request_ms
+        self.metrics = metrics
+        self.exclude_paths = exclude_paths
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in self.exclude_paths:
+            return await self.app(scope, receive, send)
+
+        stats = RequestStats(keep_statements=self.slow_request_ms > 0)
+        token = _current.set(stats)
+        status = 500
+
+        async def send_with_stats(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if self.header:
+                    message["headers"] = [*message.get("headers", []), (QUERY_COUNT_HEADER, str(stats.count).encode())]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_stats)
+        finally:
+            _current.reset(token)
+            seconds = time.perf_counter() - start
+            route = _route_template(scope)
+            self.metrics.record(scope["method"], route, status, seconds, stats)
+            if self.slow_request_ms and seconds * 1e3 >= self.slow_request_ms:
+                self._log_slow_request(scope, route, status, seconds, stats)
+
+    @staticmethod
+    def _log_slow_request(scope, route, status, seconds, stats: RequestStats):
+        phases = ", ".join(f"{phase} {phase_seconds * 1e3:.1f} ms" for phase, phase_seconds in stats.phases.items())
+        # in execution order, so repeated statements (N+1) stand out
+        statements = "".join(f"\n  {elapsed * 1e3:8.1f} ms  {statement}" for elapsed, statement in stats.statements)
+        logger.warning(
+            "Slow request %s %s (%s) -> %s in %.1f ms: %d statements in %.1f ms%s%s",
+            scope["method"], scope["path"], route, status, seconds * 1e3, stats.count, stats.sql_seconds * 1e3,
+            f", {phases}" if phases else "", statements,
+        )
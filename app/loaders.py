@@ -0,0 +1,103 @@
+# Request-scoped data loaders
+#
+# A handler (and the helpers it calls) asks a loader for rows by key instead of querying them one at
+# a time: keys requested in the same event loop iteration are fetched with one query, and each key
+# is fetched at most once per request. Loaders live as long as the request's AsyncSession.
+import asyncio
+from typing import Awaitable, Callable, Dict, Hashable, Iterable, List
+
+from fastapi import Depends
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.database import get_async_db
+from app.queries import QUERY_DATAPOINT_OBJECT_IDS, QUERY_DATAPOINTS_WITH_ASSOCIATION, QUERY_OBJECTS_BY_IDS
+
+
+class DataLoader:
+    """Batches and caches lookups by key; `batch_load(keys)` returns {key: value} for the keys found,
+    missing keys load as None
+    """
+
+    def __init__(self, batch_load: Callable[[List[Hashable]], Awaitable[Dict]]):
+        self._batch_load = batch_load
+        self._futures: Dict[Hashable, asyncio.Future] = {}
+        self._queue: List[Hashable] = []
+
+    def load(self, key) -> Awaitable:
+        future = self._futures.get(key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = self._futures[key] = loop.create_future()
+            self._queue.append(key)
+            if len(self._queue) == 1:
+                # dispatch once the callers of this iteration have queued their keys
+                loop.call_soon(lambda: asyncio.ensure_future(self._dispatch()))
+        return future
+
+    async def load_many(self, keys: Iterable) -> list:
+        return list(await asyncio.gather(*(self.load(key) for key in keys)))
+
+    def prime(self, key, value):
+        """Caches a value the caller already has, replacing any cached one
+        """
+        future = self._futures.get(key)
+        if future is not None and not future.done():
+            # someone is waiting on a queued load of this key
+            future.set_result(value)
+            return
+        future = asyncio.get_running_loop().create_future()
+        future.set_result(value)
+        self._futures[key] = future
+
+    def clear(self, key):
+        self._futures.pop(key, None)
+
+    async def _dispatch(self):
+        keys, self._queue = self._queue, []
+        try:
+            found = await self._batch_load(keys)
+        except Exception as e:
+            for key in keys:
+                # a failed key is not cached, the next load tries again
+                future = self._futures.pop(key, None)
+                if future is not None and not future.done():
+                    future.set_exception(e)
+            return
+        for key in keys:
+            future = self._futures.get(key)
+            if future is not None and not future.done():
+                future.set_result(found.get(key))
+
+
+class Loaders:
+    """The loaders of one request, all reading through the request's session
+    """
+
+    def __init__(self, db: AsyncSession):
+        self.db = db
+        self.objects = DataLoader(self._load_objects)
+        self.datapoints = DataLoader(self._load_datapoints)
+        self.datapoint_object_ids = DataLoader(self._load_datapoint_object_ids)
+
+    async def _load_objects(self, ids):
+        return {_object.id: _object for _object in (await self.db.execute(QUERY_OBJECTS_BY_IDS, {"ids": ids})).scalars()}
+
+    async def _load_datapoints(self, ids):
+        # the association comes with the datapoint, so the object id lookup that usually follows is free
+        rows = await self.db.execute(QUERY_DATAPOINTS_WITH_ASSOCIATION, {"ids": ids})
+        datapoints = {}
+        for datapoint, object_id in rows:
+            if datapoint.id not in datapoints:
+                datapoints[datapoint.id] = datapoint
+                self.datapoint_object_ids.prime(datapoint.id, object_id)
+        return datapoints
+
+    async def _load_datapoint_object_ids(self, ids):
+        rows = await self.db.execute(QUERY_DATAPOINT_OBJECT_IDS, {"ids": ids})
+        return {datapoint_id: object_id for datapoint_id, object_id in rows}
+
+
+def get_loaders(db: AsyncSession = Depends(get_async_db)) -> Loaders:
+    """Request-scoped: FastAPI resolves a dependency once per request, with the handler's own session
+    """
+    return Loaders(db)
@@ -66,3 +66,63 @@ class DatapointResponse(BaseModel):
 
     class Config:
         from_attributes = True
+
+
+class DatapointPage(BaseModel):
+    items: List[DatapointResponse]
+    next_cursor: Optional[str] = Field(None, description="Pass as `cursor` to get the next page, null on the last page")
+
+
+class DatapointBatch(BaseModel):
+    items: List[DatapointResponse] = Field(..., description="The datapoints found, in the order of the requested ids")
+    missing: List[int] = Field(..., description="Requested ids without a datapoint")
+
+
+class DatapointBulkCreateItem(DatapointCreate):
+    object_id: int = Field(..., description="ID of the object the datapoint belongs to")
+
+
+class DatapointBulkCreate(BaseModel):
+    items: List[DatapointBulkCreateItem] = Field(..., min_length=1, max_length=10000)
+
+
+class DatapointBulkError(BaseModel):
+    index: int = Field(..., description="Position of the item in the request")
+    object_id: Optional[int] = None
+    detail: str
+
+
+class DatapointBulkCreateResponse(BaseModel):
+    created: List[DatapointResponse]
+    errors: List[DatapointBulkError]
+
+
+class DatapointValueUpdate(BaseModel):
+    id: int
+    value: Optional[str] = None
+    is_fresh: Optional[bool] = None
+
+
+class DatapointValuesUpdate(BaseModel):
+    updates: List[DatapointValueUpdate] = Field(..., min_length=1, max_length=10000)
+
+
+class DatapointValuesUpdateResponse(BaseModel):
+    changed: List[int] = Field(..., description="IDs of the datapoints whose value or freshness changed")
+
+
+class DatapointHistoryPoint(BaseModel):
+    ts: datetime = Field(..., description="Start of the bucket")
+    min: Optional[float] = None
+    max: Optional[float] = None
+    avg: Optional[float] = None
+    last: Optional[str] = Field(None, description="Last value in the bucket, numeric or not")
+    count: int
+
+
+class DatapointHistoryResponse(BaseModel):
+    datapoint_id: int
+    start: datetime
+    end: datetime
+    bucket_seconds: int
+    points: List[DatapointHistoryPoint]
@@ -0,0 +1,37 @@
+from datetime import datetime
+from typing import List, Optional
+
+import msgspec
+
+
+# msgspec Structs for the large tree responses, encoded directly to JSON bytes by
+# app/responses.py without going through pydantic or jsonable_encoder
+class DatapointNode(msgspec.Struct):
+    id: int
+    name: str
+    type: Optional[str]
+    value: Optional[str]
+    unit: Optional[str]
+    is_fresh: Optional[bool]
+    created_at: Optional[datetime]
+    updated_at: Optional[datetime]
+
+
+class TreeNode(msgspec.Struct):
+    """One object of GET /api/objects/tree
+    """
+    id: int
+    name: str
+    type: str
+    child_count: int  # also set when `children` was cut off by a depth limit
+    children: List["TreeNode"]
+
+
+class PathTreeNode(msgspec.Struct, omit_defaults=True):
+    """One object of a path query result, `datapoints` is only present on the objects matched by the path
+    """
+    id: int
+    name: str
+    type: str
+    children: List["PathTreeNode"]
+    datapoints: Optional[List[DatapointNode]] = None
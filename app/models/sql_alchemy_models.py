@@ -1,7 +1,7 @@
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import relationship, deferred
 from sqlalchemy.sql import func
-from sqlalchemy import Column, Integer, String, TIMESTAMP, ForeignKey, CheckConstraint, JSON, DateTime, Text, Boolean, \
-    UniqueConstraint
+from sqlalchemy import Column, Integer, String, TIMESTAMP, ForeignKey, CheckConstraint, JSON, DateTime, Text, Boolean, Double, \
+    UniqueConstraint, Index
 
 from pydantic import BaseModel, Field
 from typing import Optional, Dict, Any, List
@@ -17,7 +17,7 @@ class Object(Base):
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String(255), nullable=False)
     type = Column(String(50), nullable=False, index=True)
-    parent_id = Column(Integer, ForeignKey("object.id", ondelete="CASCADE"), nullable=True)
+    parent_id = Column(Integer, ForeignKey("object.id", ondelete="CASCADE"), nullable=True, index=True)
     location_details = Column(JSON, nullable=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
@@ -32,6 +32,21 @@ class Object(Base):
     #                           back_populates="object")
 
 
+class ObjectClosure(Base):
+    """Closure table of the object hierarchy: one row per (ancestor, descendant) pair, including
+    each object paired with itself at depth 0. Maintained by app/closure.py.
+    """
+    __tablename__ = "object_closure"
+
+    ancestor_id = Column(Integer, ForeignKey("object.id", ondelete="CASCADE"), primary_key=True)
+    descendant_id = Column(Integer, ForeignKey("object.id", ondelete="CASCADE"), primary_key=True)
+    depth = Column(Integer, nullable=False)
+
+    __table_args__ = (
+        Index("ix_object_closure_descendant_depth", "descendant_id", "depth"),
+    )
+
+
 class Datapoint(Base):
     __tablename__ = "datapoint"
 
@@ -43,6 +58,20 @@ class Datapoint(Base):
     updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
     is_fresh = Column(Boolean, default=True)
     type = Column(String(50))
+    # expiry of the last reading (migrations/0002_datapoint_freshness.sql), deferred so it is only
+    # loaded by the freshness code
+    fresh_until = deferred(Column(DateTime(timezone=True), nullable=True))
+    # time of the last value write (migrations/0006_datapoint_value_updated_at.sql), deferred so it is
+    # only loaded by the write-behind code
+    value_updated_at = deferred(Column(DateTime(timezone=True), nullable=True))
+
+    __table_args__ = (
+        # keyset pagination of the datapoint listing (migrations/0005_datapoint_listing_indexes.sql)
+        Index("ix_datapoint_type_id", "type", "id"),
+        Index("ix_datapoint_unit_id", "unit", "id"),
+        Index("ix_datapoint_is_fresh_id", "is_fresh", "id"),
+        Index("ix_datapoint_updated_at_id", "updated_at", "id"),
+    )
 
     # Relationships
     # objects = relationship("Object",
@@ -55,7 +84,7 @@ class ObjectDatapoint(Base):
 
     id = Column(Integer, primary_key=True, index=True)
     object_FK = Column(Integer, ForeignKey("object.id", ondelete="CASCADE"), nullable=False)
-    datapoint_FK = Column(Integer, ForeignKey("datapoint.id", ondelete="CASCADE"), nullable=False)
+    datapoint_FK = Column(Integer, ForeignKey("datapoint.id", ondelete="CASCADE"), nullable=False, index=True)
     last_updated = Column(DateTime(timezone=True), server_default=func.now())
 
     # Relationships (optional, for direct access)
@@ -66,3 +95,18 @@ class ObjectDatapoint(Base):
         # Unique constraint to prevent duplicate object-datapoint pairs
         UniqueConstraint("object_FK", "datapoint_FK", name="unique_object_datapoint"),
     )
+
+
+class DatapointHistory(Base):
+    """Append-only value history, range-partitioned by month on ts (see migrations/0001_datapoint_history.sql)
+    """
+    __tablename__ = "datapoint_history"
+
+    datapoint_FK = Column(Integer, primary_key=True)
+    ts = Column(DateTime(timezone=True), primary_key=True)
+    value_num = Column(Double, nullable=True)  # numeric values are stored compactly here
+    value_text = Column(Text, nullable=True)  # only for values that are not numbers
+
+    __table_args__ = (
+        {"postgresql_partition_by": "RANGE (ts)"},
+    )
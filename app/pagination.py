@@ -0,0 +1,21 @@
+# Opaque cursors of the keyset-paginated listings
+import base64
+import json
+
+
+def encode_cursor(position: dict) -> str:
+    """Encodes the sort key of the last row of a page, e.g. {"id": 42}
+    """
+    return base64.urlsafe_b64encode(json.dumps(position, separators=(",", ":")).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> dict:
+    """Inverse of encode_cursor, raises ValueError for a malformed cursor
+    """
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (ValueError, TypeError) as e:
+        raise ValueError("Invalid cursor") from e
+    if not isinstance(position, dict):
+        raise ValueError("Invalid cursor")
+    return position
@@ -0,0 +1,261 @@
+# Compiler and executor for dotted path expressions such as `building.floor.room.temperature`
+#
+# Grammar: a path is a list of steps separated by dots. All steps but the last select objects,
+# the last one selects datapoints of the reached objects.
+#   room            children of type `room` (case-insensitive)
+#   *               children of any type
+#   **              zero or more levels of descendants (object steps only)
+#   room[name=1*]   name predicate, `*` and `?` act as wildcards
+import re
+from functools import lru_cache
+from typing import NamedTuple, Optional, Pattern, Tuple
+
+from sqlalchemy import text
+
+DESCENDANTS = '**'
+ANY = '*'
+
+_STEP_RE = re.compile(r'^(?P<type>\*\*|\*|[^.\[\]*]+)(?:\[name=(?P<name>[^\]]*)\])?$')
+
+
+class PathSyntaxError(ValueError):
+    pass
+
+
+class Step(NamedTuple):
+    type: Optional[str]  # lower-cased type, None for `*`, DESCENDANTS for `**`
+    name: Optional[Pattern] = None
+    name_pattern: Optional[str] = None
+
+    def matches(self, item) -> bool:
+        if self.type is not None and (item.get('type') or '').lower() != self.type:
+            return False
+        return self.name is None or bool(self.name.match(item.get('name') or ''))
+
+
+class PathPlan(NamedTuple):
+    object_steps: Tuple[Step, ...]
+    datapoint_step: Step
+
+    @property
+    def has_descendant_steps(self) -> bool:
+        return any(step.type == DESCENDANTS for step in self.object_steps)
+
+
+def glob_to_regex(pattern: str) -> Pattern:
+    """Translates a name pattern where `*` and `?` are wildcards
+    """
+    translated = ''.join('.*' if ch == '*' else '.' if ch == '?' else re.escape(ch) for ch in pattern)
+    return re.compile(f'{translated}\\Z')
+
+
+def _split_steps(path: str):
+    steps, current, depth = [], [], 0
+    for ch in path:
+        if ch == '[':
+            depth += 1
+        elif ch == ']':
+            depth -= 1
+        if ch == '.' and depth == 0:
+            steps.append(''.join(current))
+            current = []
+        else:
+            current.append(ch)
+    steps.append(''.join(current))
+    return steps
+
+
+def _parse_step(raw: str) -> Step:
+    match = _STEP_RE.match(raw.strip())
+    if not match:
+        raise PathSyntaxError(f"Invalid path step '{raw}'")
+    step_type, name = match.group('type').strip(), match.group('name')
+    if step_type == DESCENDANTS:
+        if name is not None:
+            raise PathSyntaxError("'**' does not take a name predicate")
+        return Step(DESCENDANTS)
+    return Step(
+        type=None if step_type == ANY else step_type.lower(),
+        name=glob_to_regex(name) if name is not None else None,
+        name_pattern=name
+    )
+
+
+@lru_cache(maxsize=1024)
+def compile_path(path: str) -> PathPlan:
+    """Parses a path expression once into a step plan, plans are cached by path string
+    """
+    steps = [_parse_step(raw) for raw in _split_steps(path)]
+    if steps[-1].type == DESCENDANTS:
+        raise PathSyntaxError("A path cannot end with '**', the last step selects datapoints")
+    return PathPlan(object_steps=tuple(steps[:-1]), datapoint_step=steps[-1])
+
+
+def _start_step(plan: PathPlan, root) -> Optional[int]:
+    """The first step may name the root itself (`building.floor...` queried from a building)
+    """
+    steps = plan.object_steps
+    if steps and steps[0].type not in (None, DESCENDANTS) and steps[0].type == (root.get('type') or '').lower():
+        return 1 if steps[0].matches(root) else None
+    return 0
+
+
+def execute_path(plan: PathPlan, root):
+    """Runs a compiled plan over a subtree built by `build_subtree_with_datapoints`.
+
+    Returns the reached objects that hold at least one matching datapoint, in tree order,
+    each with only the matching datapoints.
+    """
+    start = _start_step(plan, root)
+    if start is None:
+        return []
+
+    steps = plan.object_steps
+    children_by_type = {}
+    results = {}
+    seen = set()
+    stack = [(root, start)]
+    while stack:
+        node, i = stack.pop()
+        if (node['id'], i) in seen:
+            continue
+        seen.add((node['id'], i))
+
+        if i == len(steps):
+            datapoints = [dp for dp in node['datapoints'] if dp.get('id') and dp.get('type')
+                          and plan.datapoint_step.matches(dp)]
+            if datapoints and node['id'] not in results:
+                results[node['id']] = {
+                    "id": node["id"],
+                    "name": node["name"],
+                    "type": node["type"],
+                    "location_details": node["location_details"],
+                    "datapoints": datapoints
+                }
+            continue
+
+        step = steps[i]
+        if step.type == DESCENDANTS:
+            stack.extend((child, i) for child in reversed(node['children']))
+            stack.append((node, i + 1))
+            continue
+
+        if step.type is None:
+            candidates = node['children']
+        else:
+            index = children_by_type.get(node['id'])
+            if index is None:
+                index = children_by_type[node['id']] = {}
+                for child in node['children']:
+                    index.setdefault((child['type'] or '').lower(), []).append(child)
+            candidates = index.get(step.type, ())
+        stack.extend((child, i + 1) for child in reversed(candidates) if step.name is None or step.matches(child))
+
+    return list(results.values())
+
+
+# SQL-side evaluation for plans without `**`: every object step is one level of the recursive CTE,
+# so branches that cannot match are pruned in the database and only matching datapoints are returned.
+QUERY_PATH_PRUNED = text("""
+    WITH RECURSIVE object_path AS (
+        SELECT
+            o.id,
+            o.name,
+            o.type,
+            o.location_details,
+            CASE WHEN lower(o.type) = CAST(:root_type AS text) THEN 1 ELSE 0 END AS step,
+            ARRAY[o.id] AS sort_path
+        FROM public."object" o
+        WHERE o.id = :object_id
+          AND (lower(o.type) IS DISTINCT FROM CAST(:root_type AS text)
+               OR CAST(:root_name AS text) IS NULL OR o.name LIKE :root_name)
+        UNION ALL
+        SELECT
+            o.id,
+            o.name,
+            o.type,
+            o.location_details,
+            op.step + 1,
+            op.sort_path || o.id
+        FROM object_path op
+        INNER JOIN public."object" o ON o.parent_id = op.id
+        WHERE op.step < :n_steps
+          AND ((CAST(:types AS text[]))[op.step + 1] IS NULL OR lower(o.type) = (CAST(:types AS text[]))[op.step + 1])
+          AND ((CAST(:names AS text[]))[op.step + 1] IS NULL OR o.name LIKE (CAST(:names AS text[]))[op.step + 1])
+    )
+    SELECT
+        op.id,
+        op.name,
+        op.type,
+        op.location_details,
+        d.id as datapoint_id,
+        d.name as datapoint_name,
+        d.type as datapoint_type,
+        d.value,
+        d.unit,
+        d.is_fresh,
+        d.created_at,
+        d.updated_at
+    FROM object_path op
+    INNER JOIN public.object_datapoint od ON op.id = od."object_FK"
+    INNER JOIN public.datapoint d ON od."datapoint_FK" = d.id
+    WHERE op.step = :n_steps
+      AND d.type <> ''
+      AND (CAST(:datapoint_type AS text) IS NULL OR lower(d.type) = :datapoint_type)
+      AND (CAST(:datapoint_name AS text) IS NULL OR d.name LIKE :datapoint_name)
+    ORDER BY op.sort_path, d.id;
+""")
+
+
+def glob_to_like(pattern: Optional[str]) -> Optional[str]:
+    """Translates a name pattern where `*` and `?` are wildcards into a LIKE pattern
+    """
+    if pattern is None:
+        return None
+    escaped = pattern.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return escaped.replace('*', '%').replace('?', '_')
+
+
+def sql_params(plan: PathPlan, object_id: int):
+    """Bind parameters of QUERY_PATH_PRUNED for a plan without `**` steps
+    """
+    if plan.has_descendant_steps:
+        raise ValueError("Plans with '**' steps cannot be evaluated in SQL")
+    steps = plan.object_steps
+    root_step = steps[0] if steps and steps[0].type is not None else None
+    return {
+        "object_id": object_id,
+        "root_type": root_step.type if root_step else None,
+        "root_name": glob_to_like(root_step.name_pattern) if root_step else None,
+        "n_steps": len(steps),
+        "types": [step.type for step in steps],
+        "names": [glob_to_like(step.name_pattern) for step in steps],
+        "datapoint_type": plan.datapoint_step.type,
+        "datapoint_name": glob_to_like(plan.datapoint_step.name_pattern),
+    }
+
+
+def collect_path_rows(rows):
+    """Groups rows of QUERY_PATH_PRUNED (ordered by object) into the output of execute_path
+    """
+    results = []
+    for row in rows:
+        if not results or results[-1]['id'] != row['id']:
+            results.append({
+                "id": row["id"],
+                "name": row["name"],
+                "type": row["type"],
+                "location_details": row["location_details"],
+                "datapoints": []
+            })
+        results[-1]['datapoints'].append({
+            'id': row['datapoint_id'],
+            'name': row['datapoint_name'],
+            'type': row['datapoint_type'],
+            'value': row['value'],
+            'unit': row['unit'],
+            'is_fresh': row['is_fresh'],
+            'created_at': row['created_at'],
+            'updated_at': row['updated_at']
+        })
+    return results
@@ -0,0 +1,125 @@
+# Connection pool instrumentation, exposed on GET /api/admin/pool
+import threading
+import time
+from bisect import bisect_left
+
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+
+# upper bounds (ms) of the checkout latency histogram buckets
+LATENCY_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class PoolMetrics:
+    """Counters and a checkout latency histogram for one engine's pool
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.checkins = 0
+        self.connections_opened = 0
+        self.invalidations = 0
+        self.timeouts = 0
+        self.checked_out = 0
+        self.waiting = 0
+        self.max_waiting = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        self.wait_buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+    def wait_started(self):
+        with self._lock:
+            self.waiting += 1
+            self.max_waiting = max(self.max_waiting, self.waiting)
+
+    def wait_finished(self, seconds: float, timed_out: bool = False):
+        with self._lock:
+            self.waiting -= 1
+            self.wait_seconds_total += seconds
+            self.wait_seconds_max = max(self.wait_seconds_max, seconds)
+            self.wait_buckets[bisect_left(LATENCY_BUCKETS_MS, seconds * 1e3)] += 1
+            if timed_out:
+                self.timeouts += 1
+
+    def attach(self, pool):
+        """Registers the pool event listeners that maintain the connection counters
+        """
+        def _on_connect(dbapi_connection, connection_record):
+            with self._lock:
+                self.connections_opened += 1
+
+        def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+            with self._lock:
+                self.checkouts += 1
+                self.checked_out += 1
+
+        def _on_checkin(dbapi_connection, connection_record):
+            with self._lock:
+                self.checkins += 1
+                self.checked_out -= 1
+
+        def _on_invalidate(dbapi_connection, connection_record, exception):
+            with self._lock:
+                self.invalidations += 1
+
+        event.listen(pool, "connect", _on_connect)
+        event.listen(pool, "checkout", _on_checkout)
+        event.listen(pool, "checkin", _on_checkin)
+        event.listen(pool, "invalidate", _on_invalidate)
+
+    def snapshot(self, pool=None):
+        with self._lock:
+            acquisitions = sum(self.wait_buckets)
+            cumulative, buckets = 0, {}
+            for bound, count in zip(LATENCY_BUCKETS_MS + ('+Inf',), self.wait_buckets):
+                cumulative += count
+                buckets[str(bound)] = cumulative
+            result = {
+                "checkouts": self.checkouts,
+                "checkins": self.checkins,
+                "checked_out": self.checked_out,
+                "connections_opened": self.connections_opened,
+                "invalidations": self.invalidations,
+                "timeouts": self.timeouts,
+                "waiting": self.waiting,
+                "max_waiting": self.max_waiting,
+                "checkout_wait_ms": {
+                    "count": acquisitions,
+                    "mean": self.wait_seconds_total / acquisitions * 1e3 if acquisitions else 0.0,
+                    "max": self.wait_seconds_max * 1e3,
+                    "buckets": buckets,
+                },
+            }
+        if pool is not None:
+            result["pool"] = {
+                "class": type(pool).__mro__[1].__name__,
+                "size": pool.size(),
+                "checked_in": pool.checkedin(),
+                "overflow": pool.overflow(),
+                "status": pool.status(),
+            }
+        return result
+
+
+def instrumented_pool_class(base, metrics: PoolMetrics):
+    """Subclass of a queue pool class that times every connection acquisition.
+
+    SQLAlchemy has no pool event fired before a checkout starts waiting, so the wait is
+    measured around `_do_get`. The subclass carries `metrics` as a class attribute so pools
+    re-created by `engine.dispose()` keep reporting into the same object.
+    """
+    def _do_get(self):
+        self.metrics.wait_started()
+        start = time.perf_counter()
+        timed_out = False
+        try:
+            return base._do_get(self)
+        except PoolTimeoutError:
+            timed_out = True
+            raise
+        finally:
+            self.metrics.wait_finished(time.perf_counter() - start, timed_out)
+
+    return type(f"Instrumented{base.__name__}", (base,), {"metrics": metrics, "_do_get": _do_get})
@@ -0,0 +1,84 @@
+# Hot read statements of the object and datapoint endpoints, built once at import
+#
+# Every value is a bound parameter, so each statement has one SQL text whatever it is called with:
+# SQLAlchemy compiles it once per engine (compiled cache) and asyncpg prepares it once per connection
+# (prepared statement cache, DB_PREPARED_STATEMENT_CACHE_SIZE), Postgres then skips parsing and can
+# reuse the plan. Id lists are bound as one array (`= ANY(:ids)`) rather than expanded to `IN (...)`,
+# which would give a new text, and a new prepared statement, for every list length.
+# Statements of one feature stay next to it (closure.py, path_query.py, hierarchy_cache.py ...).
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import Integer, bindparam, any_, select
+from sqlalchemy.dialects.postgresql import ARRAY
+
+from app.models.sql_alchemy_models import Datapoint, Object, ObjectClosure, ObjectDatapoint
+
+
+def id_array(name: str):
+    """Bind parameter of a list of ids, sent as one integer[] value
+    """
+    return bindparam(name, type_=ARRAY(Integer))
+
+
+# the object of a datapoint, labelled `object_id`
+OBJECT_ID_COLUMN = (
+    select(ObjectDatapoint.object_FK).where(ObjectDatapoint.datapoint_FK == Datapoint.id).limit(1)
+    .scalar_subquery().label("object_id")
+)
+
+# get_object
+QUERY_OBJECT = select(Object).where(Object.id == bindparam("object_id"))
+QUERY_CHILD_OBJECTS = select(Object).where(Object.parent_id == bindparam("object_id"))
+QUERY_OBJECT_DATAPOINTS = (
+    select(Datapoint.id, Datapoint.name, Datapoint.value, Datapoint.unit, Datapoint.type)
+    .join(ObjectDatapoint, ObjectDatapoint.datapoint_FK == Datapoint.id)
+    .where(ObjectDatapoint.object_FK == bindparam("object_id"))
+)
+
+# get_objects_batch, loaders
+QUERY_OBJECTS_BY_IDS = select(Object).where(Object.id == any_(id_array("ids")))
+QUERY_CHILD_OBJECTS_BY_IDS = select(Object).where(Object.parent_id == any_(id_array("ids"))).order_by(Object.id)
+QUERY_DATAPOINTS_OF_OBJECTS = (
+    select(ObjectDatapoint.object_FK, Datapoint.id, Datapoint.name, Datapoint.value, Datapoint.unit, Datapoint.type)
+    .join(Datapoint, Datapoint.id == ObjectDatapoint.datapoint_FK)
+    .where(ObjectDatapoint.object_FK == any_(id_array("ids")))
+)
+
+# get_datapoint, get_datapoints_batch
+QUERY_DATAPOINT = select(Datapoint, OBJECT_ID_COLUMN).where(Datapoint.id == bindparam("datapoint_id"))
+QUERY_DATAPOINTS_BY_IDS = select(Datapoint, OBJECT_ID_COLUMN).where(Datapoint.id == any_(id_array("ids")))
+
+# loaders: a datapoint with the object it is associated with (none: NULL)
+QUERY_DATAPOINTS_WITH_ASSOCIATION = (
+    select(Datapoint, ObjectDatapoint.object_FK)
+    .outerjoin(ObjectDatapoint, ObjectDatapoint.datapoint_FK == Datapoint.id)
+    .where(Datapoint.id == any_(id_array("ids")))
+)
+QUERY_DATAPOINT_OBJECT_IDS = (
+    select(ObjectDatapoint.datapoint_FK, ObjectDatapoint.object_FK)
+    .where(ObjectDatapoint.datapoint_FK == any_(id_array("ids")))
+)
+
+
+def datapoint_listing(datapoint_type: Optional[str] = None, is_fresh: Optional[bool] = None, unit: Optional[str] = None,
+                      updated_since: Optional[datetime] = None, object_id: Optional[int] = None):
+    """list_datapoints: the ordered datapoints (with `object_id`) matching the filters, a page adds the
+    cursor condition and a limit. Ordered by id, or by (updated_at, id) with `updated_since`.
+    """
+    query = select(Datapoint, OBJECT_ID_COLUMN)
+    if datapoint_type is not None:
+        query = query.where(Datapoint.type == datapoint_type)
+    if is_fresh is not None:
+        query = query.where(Datapoint.is_fresh == is_fresh)
+    if unit is not None:
+        query = query.where(Datapoint.unit == unit)
+    if object_id is not None:
+        query = query.where(Datapoint.id.in_(
+            select(ObjectDatapoint.datapoint_FK)
+            .join(ObjectClosure, ObjectClosure.descendant_id == ObjectDatapoint.object_FK)
+            .where(ObjectClosure.ancestor_id == object_id)
+        ))
+    if updated_since is not None:
+        return query.where(Datapoint.updated_at >= updated_since).order_by(Datapoint.updated_at, Datapoint.id)
+    return query.order_by(Datapoint.id)
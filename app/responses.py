@@ -0,0 +1,31 @@
+# Fast JSON responses for the large dict/struct tree endpoints
+import msgspec
+from fastapi.responses import Response
+
+_encoder = msgspec.json.Encoder()
+
+
+def encode_json(content) -> bytes:
+    """Encodes msgspec Structs, dicts, lists and datetimes straight to JSON bytes
+    """
+    return _encoder.encode(content)
+
+
+class MsgspecJSONResponse(Response):
+    """JSON response rendered by msgspec.
+
+    Endpoints return an instance of this class, so FastAPI skips `jsonable_encoder` and the
+    standard json module. `content` may also be bytes that were already encoded.
+    """
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        if isinstance(content, bytes):
+            return content
+        return encode_json(content)
+
+
+def not_modified(etag: str) -> Response:
+    """304 answer to a matching If-None-Match, without a body
+    """
+    return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
@@ -0,0 +1,22 @@
+# Gunicorn worker class of the production server (gunicorn.conf.py)
+from uvicorn_worker import UvicornWorker as _UvicornWorker
+
+# seconds kept between uvicorn's own shutdown deadline and gunicorn's SIGKILL, for the lifespan shutdown
+SHUTDOWN_MARGIN = 5
+
+
+class UvicornWorker(_UvicornWorker):
+    """Uvicorn worker that drains within gunicorn's graceful_timeout.
+
+    The stock worker does not pass graceful_timeout to uvicorn, which then waits for every open
+    connection (a subscription stream never ends) until gunicorn kills the worker, skipping the
+    lifespan shutdown and with it the last write-behind flush. Here uvicorn stops accepting,
+    lets in-flight requests finish, closes what is still open shortly before the deadline and
+    then runs the lifespan shutdown.
+    """
+
+    CONFIG_KWARGS = {"loop": "auto", "http": "auto"}
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.config.timeout_graceful_shutdown = max(1, self.cfg.graceful_timeout - SHUTDOWN_MARGIN)
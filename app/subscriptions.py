@@ -0,0 +1,208 @@
+# Real-time datapoint change subscriptions
+#
+# Writers queue one NOTIFY per changed datapoint in their transaction (delivered on commit), every
+# worker process holds one LISTEN connection and fans the changes out to its SSE subscribers.
+import asyncio
+import json
+import logging
+import os
+from collections import defaultdict
+from typing import Optional
+
+import asyncpg
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.database import ASYNCPG_DSN, env_flag
+from app.hierarchy_cache import hierarchy_cache
+from app.path_query import PathPlan, execute_path
+
+logger = logging.getLogger(__name__)
+
+SUBSCRIPTIONS_ENABLED = env_flag("DATAPOINT_SUBSCRIPTIONS", False)
+QUEUE_SIZE = int(os.getenv("DATAPOINT_SUBSCRIPTION_QUEUE_SIZE", 1000))
+CHANNEL = "datapoint_changes"
+RECONNECT_DELAY = 2.0
+
+# The payload is built from the row as the transaction sees it. NOTIFY payloads must stay below 8000
+# bytes: a change whose JSON is longer is sent without its name and value and flagged as truncated.
+NOTIFY_DATAPOINT_CHANGES = text("""
+    SELECT pg_notify(
+        :channel,
+        CASE WHEN octet_length(payload) <= 7900 THEN payload
+             ELSE json_build_object('id', id, 'object_id', object_id, 'type', type, 'truncated', true)::text
+        END
+    )
+    FROM (
+        SELECT
+            d.id,
+            od."object_FK" AS object_id,
+            d.type,
+            json_build_object(
+                'id', d.id,
+                'object_id', od."object_FK",
+                'name', d.name,
+                'type', d.type,
+                'value', d.value,
+                'unit', d.unit,
+                'is_fresh', d.is_fresh,
+                'updated_at', d.updated_at
+            )::text AS payload
+        FROM datapoint d
+        LEFT JOIN object_datapoint od ON od."datapoint_FK" = d.id
+        WHERE d.id = ANY(CAST(:ids AS integer[]))
+    ) changes;
+""")
+
+
+async def publish_changes(db: AsyncSession, datapoint_ids):
+    """Queues a change notification for each datapoint, sent when the caller's transaction commits
+    """
+    if not SUBSCRIPTIONS_ENABLED:
+        return
+    datapoint_ids = sorted(set(datapoint_ids))
+    if not datapoint_ids:
+        return
+    await db.flush()
+    await db.execute(NOTIFY_DATAPOINT_CHANGES, {"channel": CHANNEL, "ids": datapoint_ids})
+
+
+class Subscription:
+    """One SSE client: the changes of datapoints below `object_id`, optionally filtered by datapoint
+    type and by a path expression evaluated from `object_id`
+    """
+
+    def __init__(self, object_id: int, datapoint_type: Optional[str] = None, plan: Optional[PathPlan] = None):
+        self.object_id = object_id
+        self.datapoint_type = datapoint_type.lower() if datapoint_type else None
+        self.plan = plan
+        self.queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+        self.overflowed = False
+
+    @property
+    def key(self):
+        return self.object_id, self.datapoint_type
+
+    def matches(self, chain, change) -> bool:
+        """`chain` holds the objects from `object_id` down to the object of the change
+        """
+        if self.plan is None:
+            return True
+        node = None
+        for obj in reversed(chain):
+            node = {
+                'id': obj['id'], 'name': obj['name'], 'type': obj['type'], 'location_details': None,
+                'children': [node] if node is not None else [],
+                'datapoints': [change] if node is None else [],
+            }
+        return bool(execute_path(self.plan, node))
+
+    def push(self, message: bytes):
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            # a client this far behind is told to resync instead of being fed stale changes
+            self.overflowed = True
+
+
+class ChangeDispatcher:
+    """Subscriptions indexed by (object id, datapoint type or None).
+
+    A change is matched by walking the ancestors of its object in the hierarchy cache and looking
+    up the index at each level, so the cost grows with the depth of the hierarchy and the number
+    of matching subscribers, not with the total number of subscribers.
+    """
+
+    def __init__(self):
+        self._index = defaultdict(set)
+        self.subscriptions = 0
+        self.changes = 0
+        self.delivered = 0
+        self.overflows = 0
+
+    def subscribe(self, subscription: Subscription):
+        self._index[subscription.key].add(subscription)
+        self.subscriptions += 1
+
+    def unsubscribe(self, subscription: Subscription):
+        subscribers = self._index.get(subscription.key)
+        if subscribers is None or subscription not in subscribers:
+            return
+        subscribers.discard(subscription)
+        if not subscribers:
+            del self._index[subscription.key]
+        self.subscriptions -= 1
+        if subscription.overflowed:
+            self.overflows += 1
+
+    @staticmethod
+    def _ancestry(object_id):
+        """The object and its ancestors up to the root, from the hierarchy cache (a stale one included)
+        """
+        ancestry = []
+        while object_id is not None:
+            obj = hierarchy_cache.get(object_id)
+            if obj is None or len(ancestry) > 10_000:
+                break
+            ancestry.append(obj)
+            object_id = obj['parent_id']
+        return ancestry
+
+    def dispatch(self, change: dict, message: bytes):
+        self.changes += 1
+        if not self._index:
+            return
+        ancestry = self._ancestry(change.get('object_id'))
+        datapoint_type = (change.get('type') or '').lower() or None
+        keys_types = (None, datapoint_type) if datapoint_type else (None,)
+        for level, obj in enumerate(ancestry):
+            for key_type in keys_types:
+                for subscription in self._index.get((obj['id'], key_type), ()):
+                    if subscription.plan is not None and not subscription.matches(ancestry[level::-1], change):
+                        continue
+                    subscription.push(message)
+                    self.delivered += 1
+
+    def snapshot(self):
+        return {
+            "enabled": SUBSCRIPTIONS_ENABLED,
+            "subscriptions": self.subscriptions,
+            "index_keys": len(self._index),
+            "changes_received": self.changes,
+            "messages_delivered": self.delivered,
+            "overflows": self.overflows,
+        }
+
+
+dispatcher = ChangeDispatcher()
+
+
+async def run_listener():
+    """Background loop of the app lifespan: LISTEN on the change channel and feed the dispatcher
+    """
+    def _on_notification(connection, pid, channel, payload):
+        try:
+            change = json.loads(payload)
+        except ValueError:
+            logger.warning("Ignoring malformed change notification")
+            return
+        dispatcher.dispatch(change, payload.encode())
+
+    while True:
+        connection = None
+        try:
+            connection = await asyncpg.connect(ASYNCPG_DSN)
+            lost = asyncio.Event()
+            connection.add_termination_listener(lambda _connection: lost.set())
+            await connection.add_listener(CHANNEL, _on_notification)
+            logger.info("Listening for datapoint changes")
+            await lost.wait()
+            logger.warning("Change listener connection lost, reconnecting")
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Change listener failed, reconnecting")
+        finally:
+            if connection is not None and not connection.is_closed():
+                await connection.close()
+        await asyncio.sleep(RECONNECT_DELAY)
@@ -1,38 +1,74 @@
 # Helper function to build tree structure
 from fastapi import APIRouter, HTTPException, Depends, Query, Path
 from typing import Union, List, Dict
+from collections import defaultdict
+from operator import attrgetter, itemgetter
 
+from app.loaders import Loaders
 from app.models.sql_alchemy_models import Object, Datapoint, ObjectDatapoint
 from app.models.pydantic_models import DatapointCreate, DatapointUpdate, DatapointResponse
+from app.models.response_structs import DatapointNode, PathTreeNode, TreeNode
+from sqlalchemy import delete, select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 
 
-def build_tree(objects_list, parent_id=None):
-    """Builds a hierarchical tree structure from a list of objects based on parent-child relationships.
+def index_children(objects_list, key='parent_id'):
+    """Groups objects by their parent id in a single pass, keeping the input order of siblings.
     """
-    tree = []
+    children_of = defaultdict(list)
     for obj in objects_list:
-        if obj['parent_id'] == parent_id:
-            node = {
-                'id': obj['id'],
-                'name': obj['name'],
-                'type': obj['type'],
-                'children': build_tree(objects_list, obj['id'])
-            }
-            tree.append(node)
-    return tree
+        children_of[obj[key]].append(obj)
+    return children_of
+
 
+def assemble_tree(children_of, make_node, parent_id=None, node_children=itemgetter('children'), depth=None):
+    """Iteratively assembles a tree from a parent -> children index.
 
-def build_subtree_with_datapoints(objects_list, root_id=None, first_loop=True):
-    """From a objects list, recursively builds a subtree that start from the root_id
+    `make_node` turns one object into a node holding an empty children list, which `node_children`
+    returns (the 'children' key of a dict by default). `depth` limits the number of levels below
+    `parent_id`, None assembles everything. Each object is visited once, so the cost is linear and deep hierarchies cannot hit the recursion limit.
     """
     tree = []
-    current_node = None
+    visited = set()
+    stack = [(parent_id, tree, 1)]
+    while stack:
+        _parent_id, siblings, level = stack.pop()
+        for obj in children_of.get(_parent_id, ()):
+            if obj['id'] in visited:
+                continue  # guard against cycles in parent_id
+            visited.add(obj['id'])
+            node = make_node(obj)
+            siblings.append(node)
+            if depth is None or level < depth:
+                stack.append((obj['id'], node_children(node), level + 1))
+    return tree
+
 
+def build_tree(objects_list, parent_id=None):
+    """Builds a hierarchical tree structure from a list of objects based on parent-child relationships.
+    """
+    def _make_node(obj):
+        return {
+            'id': obj['id'],
+            'name': obj['name'],
+            'type': obj['type'],
+            'children': []
+        }
+
+    return assemble_tree(index_children(objects_list), _make_node, parent_id)
+
+
+def build_subtree_with_datapoints(objects_list, root_id=None):
+    """From a objects list joined with datapoints (one row per object and datapoint),
+    builds a subtree that start from the root_id
+    """
+    nodes = {}
+    node_rows = []
     for obj in objects_list:
-        # root object
-        if obj['id'] == root_id and not current_node:
-            current_node = {
+        node = nodes.get(obj['id'])
+        if node is None:
+            node = nodes[obj['id']] = {
                 'id': obj['id'],
                 'name': obj['name'],
                 'type': obj['type'],
@@ -40,11 +76,9 @@ def build_subtree_with_datapoints(objects_list, root_id=None, first_loop=True):
                 'datapoints': [],
                 'children': []
             }
-            tree.append(current_node)
-
-        # add children and datapoints
-        if current_node:
-            obj_datapoint = {
+            node_rows.append(obj)
+        if obj['datapoint_id']:
+            node['datapoints'].append({
                 'id': obj['datapoint_id'],
                 'name': obj['datapoint_name'],
                 'type': obj['datapoint_type'],
@@ -53,93 +87,81 @@ def build_subtree_with_datapoints(objects_list, root_id=None, first_loop=True):
                 'is_fresh': obj['is_fresh'],
                 'created_at': obj['created_at'],
                 'updated_at': obj['updated_at']
-            }
-            if obj['parent_id'] == current_node['id'] and obj['id'] != current_node['id']:
-                _child_existed = False
-                # if old child:
-                for _child in current_node['children']:
-                    if _child['id'] == obj['id']:
-                        _child_existed = True
-                        _child['datapoints'].append(obj_datapoint)
-                # if new child:
-                if not _child_existed:
-                    child = {
-                        'id': obj['id'],
-                        'name': obj['name'],
-                        'type': obj['type'],
-                        'location_details': obj['location_details'],
-                        'datapoints': [obj_datapoint],
-                        'children': build_subtree_with_datapoints(objects_list, obj['id'], first_loop=False)
-                    }
-                    current_node['children'].append(child)
-
-            if obj['datapoint_id'] and obj['id'] == current_node['id']:
-                current_node['datapoints'].append(obj_datapoint)
-    if first_loop:
-        return tree
-    else:
-        return tree[0]['children']
+            })
+
+    if root_id not in nodes:
+        return []
+    root = nodes[root_id]
+    root['children'] = assemble_tree(index_children(node_rows), lambda obj: nodes[obj['id']], root_id)
+    return [root]
 
 
 def build_tree_with_node_datapoints(objects_list, nodes_with_datapoints: List, parent_id: int =None):
     """Add nodes with datapoints to an objects tree
     """
-    tree = []
-    for obj in objects_list:
-        if obj['parent_id'] == parent_id:
-            # create node
-            node = {
-                'id': obj['id'],
-                'name': obj['name'],
-                'type': obj['type'],
-                'children': build_tree_with_node_datapoints(objects_list, nodes_with_datapoints, obj['id'])
-            }
-            # if append datapoints
-            for _node_to_append in nodes_with_datapoints:
-                if _node_to_append['id'] == obj['id']:
-                    node['datapoints'] = _node_to_append['datapoints']
+    datapoints_by_id = {_node['id']: _node['datapoints'] for _node in nodes_with_datapoints}
 
-            tree.append(node)
-    return tree
+    def _make_node(obj):
+        node = {
+            'id': obj['id'],
+            'name': obj['name'],
+            'type': obj['type'],
+            'children': []
+        }
+        if obj['id'] in datapoints_by_id:
+            node['datapoints'] = datapoints_by_id[obj['id']]
+        return node
+
+    return assemble_tree(index_children(objects_list), _make_node, parent_id)
 
-def resolve_relative_path(object_root, path, list_returns=None):
-    parts = path.split('.')
-    # remove the first level of path:
-    if parts[0].lower() == object_root['type']:
-        parts.pop(0)
-
-    current_obj = object_root
-    if list_returns is None:
-        list_returns = []
-
-    current_part = parts[0]
-    if any([current_part.lower() == _child['type'].lower() for _child in current_obj['children']]):
-        # traverse children
-        next_path = '.'.join([p_ for p_ in parts[1:]])
-        for _child in current_obj['children']:
-            resolve_relative_path(_child, next_path, list_returns)
-    else:
-        filtered_datapoints = list()
-        for _datapoint in current_obj['datapoints']:
-            if _datapoint.get('type') and (current_part.lower() == _datapoint['type'].lower()):
-                filtered_datapoints.append(_datapoint)
-        if filtered_datapoints:
-            list_returns.append({
-                "id": current_obj["id"],
-                "name": current_obj["name"],
-                "type": current_obj["type"],
-                "location_details": current_obj["location_details"],
-                "datapoints": filtered_datapoints
-            })
 
-    return list_returns
+def build_tree_structs(children_of, parent_id=None, depth=None, child_counts=None):
+    """Same tree as build_tree, made of TreeNode structs, from a parent -> children index.
 
+    `depth` limits the levels returned below `parent_id`. Every node carries its number of
+    children, taken from `child_counts` (id -> count) when the index is not complete.
+    """
+    def _make_node(obj):
+        if child_counts is None:
+            child_count = len(children_of.get(obj['id'], ()))
+        else:
+            child_count = child_counts.get(obj['id'], 0)
+        return TreeNode(obj['id'], obj['name'], obj['type'], child_count, [])
+
+    return assemble_tree(children_of, _make_node, parent_id, attrgetter('children'), depth)
+
+
+def build_tree_structs_with_node_datapoints(children_of, nodes_with_datapoints: List, parent_id: int = None):
+    """Same tree as build_tree_with_node_datapoints, made of PathTreeNode structs
+    """
+    datapoints_by_id = {
+        _node['id']: [DatapointNode(**_datapoint) for _datapoint in _node['datapoints']]
+        for _node in nodes_with_datapoints
+    }
+
+    def _make_node(obj):
+        return PathTreeNode(obj['id'], obj['name'], obj['type'], [], datapoints_by_id.get(obj['id']))
 
-def update_object_association(db: Session, datapoint_id: int, object_id: int):
-    if not db.query(Object).filter(Object.id == object_id).first():
+    return assemble_tree(children_of, _make_node, parent_id, attrgetter('children'))
+
+
+async def update_object_association(db: AsyncSession, datapoint_id: int, object_id: int,
+                                    loaders: Loaders = None, replace: bool = True):
+    """Links a datapoint to an object, `replace` drops its previous association (not needed for a new datapoint).
+
+    With the request's `loaders` the object check reuses an object the handler has already loaded.
+    """
+    if loaders is not None:
+        exists = await loaders.objects.load(object_id) is not None
+    else:
+        exists = (await db.execute(select(Object.id).where(Object.id == object_id))).first() is not None
+    if not exists:
         raise HTTPException(status_code=404, detail=f"Object with id {object_id} not found")
 
-    db.query(ObjectDatapoint).filter(ObjectDatapoint.datapoint_FK == datapoint_id).delete()
+    if replace:
+        await db.execute(delete(ObjectDatapoint).where(ObjectDatapoint.datapoint_FK == datapoint_id))
+    if loaders is not None:
+        loaders.datapoint_object_ids.prime(datapoint_id, object_id)
 
     new_assoc = ObjectDatapoint(object_FK=object_id, datapoint_FK=datapoint_id)
     db.add(new_assoc)
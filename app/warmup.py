@@ -0,0 +1,161 @@
+# Startup warm-up of a worker process
+#
+# A fresh worker has empty pools, no compiled statements and no hierarchy in memory, so its first
+# requests pay for connection setup, SQL compilation and the cold tree build. The app lifespan runs
+# the warm-up before the worker starts accepting:
+# - every pool (sync and async) opens DB_POOL_SIZE connections;
+# - the read statements of the hot endpoints (app/queries.py ...) run once on each of them with an
+#   id that matches nothing, which fills SQLAlchemy's compiled statement cache and, on the asyncpg
+#   connections, their prepared statement cache;
+# - the hierarchy cache is loaded and the body of GET /api/objects/tree encoded.
+# GET /ready answers 503 until it has completed, for load balancers and rolling restarts.
+# It first checks that object_closure is in place: without it the worker fails to start, not retried.
+import asyncio
+import logging
+import os
+import time
+from contextlib import ExitStack
+
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncSession
+from sqlalchemy.orm import Session
+
+from app import closure, queries
+from app.cache_sync import CACHE_SYNC_ENABLED, cache_sync
+from app.database import POOL_SIZE, AsyncSessionLocal, async_engine, engine, env_flag
+from app.hierarchy_cache import hierarchy_cache
+from app.path_query import QUERY_PATH_PRUNED, compile_path, sql_params
+
+logger = logging.getLogger(__name__)
+
+WARMUP_ENABLED = env_flag("WARMUP", True)
+# the lifespan waits this long for the warm-up, then the worker serves (not ready) while it goes on;
+# keep it below the gunicorn timeout, which also covers the startup
+WARMUP_TIMEOUT = float(os.getenv("WARMUP_TIMEOUT", 30))
+RETRY_DELAY = 2.0
+
+# matches no row: the statements are compiled and prepared without reading anything
+NO_ID = 0
+# a path without '**', evaluated by QUERY_PATH_PRUNED
+WARMUP_PATH = "*.*"
+
+
+# statements of the endpoints served by the sync engine
+SYNC_STATEMENTS = [
+    (queries.QUERY_OBJECT, {"object_id": NO_ID}),
+    (queries.QUERY_CHILD_OBJECTS, {"object_id": NO_ID}),
+    (queries.QUERY_OBJECT_DATAPOINTS, {"object_id": NO_ID}),
+    (queries.QUERY_OBJECTS_BY_IDS, {"ids": [NO_ID]}),
+    (queries.QUERY_CHILD_OBJECTS_BY_IDS, {"ids": [NO_ID]}),
+    (queries.QUERY_DATAPOINTS_OF_OBJECTS, {"ids": [NO_ID]}),
+]
+
+# statements of the endpoints served by the async engine, loaders included
+ASYNC_STATEMENTS = [
+    (queries.QUERY_DATAPOINT, {"datapoint_id": NO_ID}),
+    (queries.QUERY_DATAPOINTS_BY_IDS, {"ids": [NO_ID]}),
+    (queries.QUERY_OBJECTS_BY_IDS, {"ids": [NO_ID]}),
+    (queries.QUERY_DATAPOINTS_WITH_ASSOCIATION, {"ids": [NO_ID]}),
+    (queries.QUERY_DATAPOINT_OBJECT_IDS, {"ids": [NO_ID]}),
+    (closure.QUERY_SUBTREE_WITH_DATAPOINTS, {"object_id": NO_ID}),
+    (QUERY_PATH_PRUNED, sql_params(compile_path(WARMUP_PATH), NO_ID)),
+]
+
+
+def _prepare_sync(connection):
+    with Session(bind=connection) as db:
+        for statement, params in SYNC_STATEMENTS:
+            db.execute(statement, params).all()
+
+
+async def _prepare_async(connection: AsyncConnection):
+    async with AsyncSession(bind=connection) as db:
+        for statement, params in ASYNC_STATEMENTS:
+            (await db.execute(statement, params)).all()
+
+
+def warm_sync_pool(size: int = POOL_SIZE):
+    """Opens `size` connections of the sync pool, held together so they are all distinct
+    """
+    with ExitStack() as stack:
+        for _ in range(size):
+            _prepare_sync(stack.enter_context(engine.connect()))
+
+
+async def warm_async_pool(size: int = POOL_SIZE):
+    opened = await asyncio.gather(*(async_engine.connect().start() for _ in range(size)), return_exceptions=True)
+    connections = [connection for connection in opened if isinstance(connection, AsyncConnection)]
+    try:
+        if len(connections) < len(opened):
+            raise next(error for error in opened if isinstance(error, BaseException))
+        await asyncio.gather(*(_prepare_async(connection) for connection in connections))
+    finally:
+        for connection in connections:
+            await connection.close()
+
+
+async def check_schema():
+    async with AsyncSessionLocal() as db:
+        await closure.check_table(db)
+
+
+async def preload_hierarchy():
+    if CACHE_SYNC_ENABLED:
+        # a change sent by another worker between the load and the LISTEN would be missed
+        await cache_sync.listening.wait()
+    async with AsyncSessionLocal() as db:
+        await hierarchy_cache.ensure_loaded_async(db)
+    await asyncio.to_thread(hierarchy_cache.tree_json)
+
+
+class WarmUp:
+    def __init__(self):
+        self.ready = False
+        self.attempts = 0
+        self.steps = {}  # step -> seconds of the last successful run
+        self.error = None
+
+    async def run_once(self):
+        for step, run in (
+            ("schema", check_schema),
+            ("sync_pool", lambda: asyncio.to_thread(warm_sync_pool)),
+            ("async_pool", warm_async_pool),
+            ("hierarchy", preload_hierarchy),
+        ):
+            start = time.perf_counter()
+            await run()
+            self.steps[step] = time.perf_counter() - start
+
+    async def run(self):
+        """Background task of the app lifespan: warms up, retrying until it succeeds, then reports ready
+        """
+        while not self.ready:
+            self.attempts += 1
+            try:
+                await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except closure.ClosureTableMissing as exc:
+                self.error = type(exc).__name__
+                logger.error("Warm-up failed: %s", exc)
+                raise
+            except Exception as exc:
+                self.error = type(exc).__name__
+                logger.exception("Warm-up failed, retrying in %.0fs", RETRY_DELAY)
+                await asyncio.sleep(RETRY_DELAY)
+            else:
+                self.ready = True
+                self.error = None
+                logger.info(
+                    "Warm-up done: %s", ", ".join(f"{step} {seconds * 1e3:.0f} ms" for step, seconds in self.steps.items())
+                )
+
+    def snapshot(self):
+        return {
+            "ready": self.ready,
+            "attempts": self.attempts,
+            "steps_ms": {step: round(seconds * 1e3, 1) for step, seconds in self.steps.items()},
+            "error": self.error,
+        }
+
+
+warmup = WarmUp()
@@ -0,0 +1,214 @@
+# Optional write-behind buffer for datapoint value updates
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime, timezone
+from typing import Dict, Optional, Tuple
+
+from sqlalchemy import func, select
+
+from app.change_tokens import change_tokens
+from app.database import AsyncSessionLocal, env_flag
+from app.datapoint_values import apply_datapoint_values
+from app.freshness import FRESHNESS_ENABLED
+
+logger = logging.getLogger(__name__)
+
+PendingUpdate = Tuple[Optional[str], Optional[bool]]
+
+
+class WriteBehindBuffer:
+    """Coalesces datapoint value updates in memory and writes them in batches.
+
+    Updates are keyed by datapoint id and the latest one wins. A background task flushes
+    the buffer every `interval` seconds, or earlier once `max_batch` datapoints are pending.
+    Once `max_pending` datapoints are pending, `submit` flushes before taking more.
+    Pending values stay readable through `pending()` until their batch is committed.
+
+    A flush does not overwrite a value written after its update was received (by a direct
+    write, or by the buffer of another worker process): the later value wins.
+    """
+
+    def __init__(self, enabled: bool, interval: float, max_batch: int, max_pending: int):
+        self.enabled = enabled
+        self.interval = interval
+        self.max_batch = max_batch
+        self.max_pending = max(max_pending, max_batch)
+        self._pending: Dict[int, PendingUpdate] = {}
+        self._received_at: Dict[int, datetime] = {}
+        self._in_flight: Dict[int, PendingUpdate] = {}
+        self._last_flush_at = None  # database time of the last committed flush
+        self._flush_lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+        self.updates_received = 0
+        self.updates_rejected = 0
+        self.updates_flushed = 0
+        self.rows_changed = 0
+        self.flushes = 0
+        self.flush_failures = 0
+        self.flush_seconds_total = 0.0
+        self.flush_seconds_max = 0.0
+        self.last_flush_seconds = 0.0
+
+    async def submit(self, datapoint_id: int, value: Optional[str], is_fresh: Optional[bool]) -> bool:
+        """Buffers an update, None fields keep the value of an earlier pending update.
+
+        A full buffer is flushed first, in the caller's request. Returns False if it is still
+        full (the flush failed): the caller writes the update directly.
+        """
+        if datapoint_id not in self._pending and len(self._pending) >= self.max_pending:
+            await self.flush()
+            if len(self._pending) >= self.max_pending:
+                self.updates_rejected += 1
+                return False
+        previous_value, previous_is_fresh = self._pending.get(datapoint_id, (None, None))
+        self._pending[datapoint_id] = (
+            value if value is not None else previous_value,
+            is_fresh if is_fresh is not None else previous_is_fresh,
+        )
+        self._received_at[datapoint_id] = datetime.now(timezone.utc)
+        self.updates_received += 1
+        if len(self._pending) >= self.max_batch:
+            self._wakeup.set()
+        return True
+
+    def pending(self, datapoint_id: int) -> Optional[PendingUpdate]:
+        """The buffered (value, is_fresh) of a datapoint, if it has not been written yet
+        """
+        pending = self._pending.get(datapoint_id)
+        in_flight = self._in_flight.get(datapoint_id)
+        if pending is None or in_flight is None:
+            return pending or in_flight
+        return (
+            pending[0] if pending[0] is not None else in_flight[0],
+            pending[1] if pending[1] is not None else in_flight[1],
+        )
+
+    def discard(self, datapoint_id: int, value: bool = True, is_fresh: bool = True):
+        """Drops the fields of a pending update that a direct write is about to supersede.
+
+        With freshness TTLs a direct value write is a reading and sets is_fresh too.
+        """
+        pending = self._pending.get(datapoint_id)
+        if pending is None:
+            return
+        is_fresh = is_fresh or (value and FRESHNESS_ENABLED)
+        pending = (None if value else pending[0], None if is_fresh else pending[1])
+        if pending == (None, None):
+            del self._pending[datapoint_id]
+            self._received_at.pop(datapoint_id, None)
+        else:
+            self._pending[datapoint_id] = pending
+
+    def overlay(self, datapoint: dict) -> dict:
+        """Returns a datapoint dict with its pending value and freshness applied, a dict without
+        'is_fresh' gets only the value
+        """
+        pending = self.pending(datapoint['id']) if self.enabled else None
+        if pending is None:
+            return datapoint
+        value, is_fresh = pending
+        datapoint = {**datapoint, 'value': value if value is not None else datapoint['value']}
+        if is_fresh is not None and 'is_fresh' in datapoint:
+            datapoint['is_fresh'] = is_fresh
+        return datapoint
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            batch, self._pending = self._pending, {}
+            received_at, self._received_at = self._received_at, {}
+            self._in_flight = batch
+            start = time.perf_counter()
+            try:
+                async with AsyncSessionLocal() as db:
+                    # the value_updated_at of the rows this flush writes, see values_update_statement
+                    flush_at = (await db.execute(select(func.now()))).scalar()
+                    changed = await apply_datapoint_values(db, batch, received_at, self._last_flush_at)
+                    await db.commit()
+                self._last_flush_at = flush_at
+            except Exception:
+                self.flush_failures += 1
+                logger.exception("Write-behind flush of %d datapoints failed, will retry", len(batch))
+                # put the batch back, fields of updates submitted meanwhile are newer and win
+                for datapoint_id, (value, is_fresh) in batch.items():
+                    newer_value, newer_is_fresh = self._pending.get(datapoint_id, (None, None))
+                    self._pending[datapoint_id] = (
+                        newer_value if newer_value is not None else value,
+                        newer_is_fresh if newer_is_fresh is not None else is_fresh,
+                    )
+                    self._received_at.setdefault(datapoint_id, received_at[datapoint_id])
+                return
+            finally:
+                self._in_flight = {}
+
+            elapsed = time.perf_counter() - start
+            if changed:
+                change_tokens.bump_datapoints()
+            self.flushes += 1
+            self.updates_flushed += len(batch)
+            self.rows_changed += len(changed)
+            self.last_flush_seconds = elapsed
+            self.flush_seconds_total += elapsed
+            self.flush_seconds_max = max(self.flush_seconds_max, elapsed)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def start(self):
+        if self.enabled and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stops the flusher and writes whatever is still pending
+        """
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    def snapshot(self):
+        return {
+            "enabled": self.enabled,
+            "interval_ms": self.interval * 1e3,
+            "max_batch": self.max_batch,
+            "max_pending": self.max_pending,
+            "buffer_depth": len(self._pending),
+            "in_flight": len(self._in_flight),
+            "updates_received": self.updates_received,
+            # submitted to a full buffer that could not be flushed, written directly instead
+            "updates_rejected": self.updates_rejected,
+            "updates_flushed": self.updates_flushed,
+            "rows_changed": self.rows_changed,
+            # updates received per datapoint written, > 1 means reports were coalesced
+            "coalescing_ratio": self.updates_received / self.updates_flushed if self.updates_flushed else None,
+            "flushes": self.flushes,
+            "flush_failures": self.flush_failures,
+            "flush_latency_ms": {
+                "last": self.last_flush_seconds * 1e3,
+                "mean": self.flush_seconds_total / self.flushes * 1e3 if self.flushes else 0.0,
+                "max": self.flush_seconds_max * 1e3,
+            },
+        }
+
+
+write_behind = WriteBehindBuffer(
+    enabled=env_flag("DATAPOINT_WRITE_BEHIND", False),
+    interval=float(os.getenv("DATAPOINT_WRITE_BEHIND_INTERVAL_MS", 500)) / 1e3,
+    max_batch=int(os.getenv("DATAPOINT_WRITE_BEHIND_MAX_BATCH", 5000)),
+    max_pending=int(os.getenv("DATAPOINT_WRITE_BEHIND_MAX_PENDING", 50000)),
+)
@@ -0,0 +1,77 @@
+"""Micro-benchmark for the tree builders in app/utils.py.
+
+Generates a synthetic hotel hierarchy (buildings > floors > rooms > devices) and
+times `build_tree` and `build_tree_with_node_datapoints` from 1k to 200k objects.
+
+Usage: python -m benchmarks.bench_build_tree [--sizes 1000 10000 ...] [--repeat 3]
+"""
+import argparse
+import time
+
+from app.utils import build_tree, build_tree_with_node_datapoints
+
+DEFAULT_SIZES = [1_000, 5_000, 20_000, 50_000, 100_000, 200_000]
+
+
+def generate_objects(n_objects, floors_per_building=10, rooms_per_floor=20, devices_per_room=4):
+    """Returns `n_objects` rows shaped like the `SELECT id, name, type, parent_id FROM object` result
+    """
+    objects = []
+    next_id = 1
+
+    def _add(name, type_, parent_id):
+        nonlocal next_id
+        objects.append({'id': next_id, 'name': name, 'type': type_, 'parent_id': parent_id})
+        next_id += 1
+        return next_id - 1
+
+    while len(objects) < n_objects:
+        building_id = _add(f'Building {next_id}', 'building', None)
+        for f in range(floors_per_building):
+            floor_id = _add(f'Floor {f}', 'floor', building_id)
+            for r in range(rooms_per_floor):
+                room_id = _add(f'Room {f}{r:02d}', 'room', floor_id)
+                for d in range(devices_per_room):
+                    _add(f'Device {d}', 'device', room_id)
+    return objects[:n_objects]
+
+
+def generate_deep_chain(n_objects):
+    """A single path of `n_objects` nested objects, deeper than the default recursion limit
+    """
+    return [{'id': i, 'name': f'Node {i}', 'type': 'room', 'parent_id': i - 1 if i > 1 else None}
+            for i in range(1, n_objects + 1)]
+
+
+def _best_of(repeat, func, *args, **kwargs):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'objects':>10} {'build_tree (ms)':>16} {'with datapoints (ms)':>21} {'us/object':>10}")
+    for size in args.sizes:
+        objects = generate_objects(size)
+        # attach datapoints to every device, as query_path does for a device-level path
+        nodes_with_datapoints = [{'id': obj['id'], 'datapoints': [{'id': obj['id'], 'type': 'temperature'}]}
+                                 for obj in objects if obj['type'] == 'device']
+        t_tree = _best_of(args.repeat, build_tree, objects)
+        t_dps = _best_of(args.repeat, build_tree_with_node_datapoints, objects, nodes_with_datapoints)
+        print(f"{size:>10} {t_tree * 1e3:>16.1f} {t_dps * 1e3:>21.1f} {t_tree / size * 1e6:>10.2f}")
+
+    chain = generate_deep_chain(50_000)
+    t_chain = _best_of(args.repeat, build_tree, chain)
+    print(f"\ndeep chain of {len(chain)} levels: {t_chain * 1e3:.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
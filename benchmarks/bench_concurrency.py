@@ -0,0 +1,81 @@
+"""Concurrency benchmark for the async route handlers.
+
+Sends a fixed number of requests to a running server at increasing numbers of in-flight
+requests and reports throughput and latency percentiles for each level. With the async
+database layer, throughput should grow with concurrency until the pool or the database
+saturates, instead of flattening at one request per event loop.
+
+Requires httpx (`pip install httpx`) and a server started with `python3 main.py`.
+
+Usage: python -m benchmarks.bench_concurrency --path /api/datapoint/1 [--levels 1 4 16 64] [--requests 2000]
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+import httpx
+
+DEFAULT_LEVELS = [1, 2, 4, 8, 16, 32, 64]
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return float('nan')
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+async def run_level(client, path, concurrency, n_requests):
+    """Runs `n_requests` GET requests with at most `concurrency` in flight
+    """
+    latencies = []
+    errors = 0
+    remaining = iter(range(n_requests))
+
+    async def _worker():
+        nonlocal errors
+        for _ in remaining:
+            start = time.perf_counter()
+            response = await client.get(path)
+            latencies.append(time.perf_counter() - start)
+            if response.status_code >= 400:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(_worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        'concurrency': concurrency,
+        'throughput': n_requests / elapsed,
+        'p50_ms': percentile(latencies, 50) * 1e3,
+        'p95_ms': percentile(latencies, 95) * 1e3,
+        'p99_ms': percentile(latencies, 99) * 1e3,
+        'mean_ms': statistics.fmean(latencies) * 1e3,
+        'errors': errors,
+    }
+
+
+async def main_async(args):
+    limits = httpx.Limits(max_connections=max(args.levels), max_keepalive_connections=max(args.levels))
+    async with httpx.AsyncClient(base_url=args.base_url, limits=limits, timeout=60) as client:
+        await run_level(client, args.path, 1, min(20, args.requests))  # warm-up
+        print(f"{'in-flight':>9} {'req/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>7}")
+        for level in args.levels:
+            result = await run_level(client, args.path, level, args.requests)
+            print(f"{result['concurrency']:>9} {result['throughput']:>9.1f} {result['p50_ms']:>8.1f} "
+                  f"{result['p95_ms']:>8.1f} {result['p99_ms']:>8.1f} {result['errors']:>7}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--base-url', default='http://localhost:8000')
+    parser.add_argument('--path', default='/api/datapoint/1')
+    parser.add_argument('--levels', type=int, nargs='+', default=DEFAULT_LEVELS)
+    parser.add_argument('--requests', type=int, default=2000)
+    asyncio.run(main_async(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""Serialization benchmark for the tree responses of /api/objects/tree and query_path.
+
+Compares, for a generated hierarchy, the default FastAPI path (dict tree -> jsonable_encoder ->
+json.dumps, as JSONResponse renders it) with the msgspec path (TreeNode structs -> msgspec encoder,
+see app/responses.py), and orjson on the dict tree when it is installed. Reports build and
+serialization time (best of `--repeat`) and the peak memory of build plus serialization.
+
+Usage: python -m benchmarks.bench_serialization [--size 100000] [--repeat 3]
+"""
+import argparse
+import gc
+import json
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+from fastapi.encoders import jsonable_encoder
+
+from app.responses import encode_json
+from app.utils import (
+    build_tree, build_tree_structs, build_tree_structs_with_node_datapoints, build_tree_with_node_datapoints,
+    index_children,
+)
+from benchmarks.bench_build_tree import generate_objects
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _json_response_render(content) -> bytes:
+    # what starlette's JSONResponse.render does after FastAPI ran jsonable_encoder
+    return json.dumps(jsonable_encoder(content), ensure_ascii=False, allow_nan=False, indent=None,
+                      separators=(",", ":")).encode("utf-8")
+
+
+def _timed(repeat, func, *args):
+    best, result = float('inf'), None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def _peak_memory(func, *args):
+    gc.collect()
+    tracemalloc.start()
+    try:
+        func(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def _cases(objects, nodes_with_datapoints):
+    children_of = index_children(objects)
+    return [
+        ("tree: dict + json", lambda: build_tree(objects), _json_response_render),
+        ("tree: dict + orjson", lambda: build_tree(objects), orjson.dumps if orjson else None),
+        ("tree: structs + msgspec", lambda: build_tree_structs(children_of), encode_json),
+        ("path: dict + json", lambda: build_tree_with_node_datapoints(objects, nodes_with_datapoints),
+         _json_response_render),
+        ("path: dict + orjson", lambda: build_tree_with_node_datapoints(objects, nodes_with_datapoints),
+         orjson.dumps if orjson else None),
+        ("path: structs + msgspec",
+         lambda: build_tree_structs_with_node_datapoints(children_of, nodes_with_datapoints), encode_json),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=int, default=100_000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    objects = generate_objects(args.size)
+    now = datetime.now(timezone.utc)
+    # one temperature datapoint on every device, as a device-level path query returns
+    nodes_with_datapoints = [
+        {'id': obj['id'], 'datapoints': [{
+            'id': obj['id'], 'name': 'temperature', 'type': 'temperature', 'value': '21.5', 'unit': 'C',
+            'is_fresh': True, 'created_at': now, 'updated_at': now,
+        }]}
+        for obj in objects if obj['type'] == 'device'
+    ]
+
+    print(f"{args.size} objects, {len(nodes_with_datapoints)} with a datapoint\n")
+    print(f"{'case':<26} {'build (ms)':>11} {'encode (ms)':>12} {'total (ms)':>11} {'peak (MB)':>10} {'body (MB)':>10}")
+    for name, build, encode in _cases(objects, nodes_with_datapoints):
+        if encode is None:
+            print(f"{name:<26} {'orjson not installed':>11}")
+            continue
+        t_build, tree = _timed(args.repeat, build)
+        t_encode, body = _timed(args.repeat, encode, tree)
+        del tree
+        peak = _peak_memory(lambda: encode(build()))
+        print(f"{name:<26} {t_build * 1e3:>11.1f} {t_encode * 1e3:>12.1f} {(t_build + t_encode) * 1e3:>11.1f} "
+              f"{peak / 2**20:>10.1f} {len(body) / 2**20:>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
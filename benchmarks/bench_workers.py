@@ -0,0 +1,103 @@
+"""Throughput scaling of the production server across worker processes.
+
+Starts the server of gunicorn.conf.py with 1, 2, 4 ... workers in turn, drives each with a fixed
+number of in-flight requests and reports throughput and latency percentiles, with the speed-up and
+per-worker efficiency against one worker. On a machine with enough cores and a database that keeps
+up, throughput should grow close to linearly until the workers outnumber the cores.
+
+Run it from the project root against a seeded database (benchmarks/seed.py): the server reads
+DATABASE_URL from the environment or .env like the app. Requires httpx and gunicorn.
+
+Usage: python -m benchmarks.bench_workers [--workers 1 2 4 8] [--path /api/objects/tree ...]
+       [--concurrency 64] [--requests 5000] [--port 8765]
+"""
+import argparse
+import asyncio
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import httpx
+
+from benchmarks.bench_concurrency import run_level
+
+DEFAULT_PATHS = ["/api/objects/tree", "/api/datapoint/1"]
+
+
+def start_server(workers: int, port: int) -> subprocess.Popen:
+    return subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "main:app",
+         "--workers", str(workers), "--bind", f"127.0.0.1:{port}"],
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+    )
+
+
+def wait_ready(base_url: str, server: subprocess.Popen, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            sys.exit(f"The server exited with status {server.returncode}:\n{server.stderr.read().decode()}")
+        try:
+            if httpx.get(base_url + "/ready", timeout=1).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    sys.exit(f"The server was not ready within {timeout:.0f}s")
+
+
+def stop_server(server: subprocess.Popen):
+    server.send_signal(signal.SIGTERM)
+    try:
+        server.wait(timeout=60)
+    except subprocess.TimeoutExpired:
+        server.kill()
+        server.wait()
+
+
+async def measure(base_url, path, concurrency, n_requests):
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as client:
+        # /ready only reflects the worker that answered, the others may still be finishing their warm-up
+        await run_level(client, path, concurrency, concurrency * 4)
+        return await run_level(client, path, concurrency, n_requests)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, os.cpu_count() or 1])
+    parser.add_argument("--path", nargs="+", default=DEFAULT_PATHS)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    base_url = f"http://127.0.0.1:{args.port}"
+    worker_counts = sorted(set(args.workers))
+    print(f"{os.cpu_count()} cores, {args.concurrency} requests in flight\n")
+    print(f"{'path':<28} {'workers':>7} {'req/s':>9} {'speed-up':>8} {'per-worker':>10} {'p50 ms':>8} "
+          f"{'p99 ms':>8} {'errors':>7}")
+
+    results = {}
+    for workers in worker_counts:
+        server = start_server(workers, args.port)
+        try:
+            wait_ready(base_url, server)
+            for path in args.path:
+                results[(path, workers)] = asyncio.run(measure(base_url, path, args.concurrency, args.requests))
+        finally:
+            stop_server(server)
+
+    for path in args.path:
+        baseline = results[(path, worker_counts[0])]["throughput"] / worker_counts[0]
+        for workers in worker_counts:
+            result = results[(path, workers)]
+            speed_up = result["throughput"] / baseline
+            print(f"{path:<28} {workers:>7} {result['throughput']:>9.1f} {speed_up:>7.2f}x {speed_up / workers:>10.0%} "
+                  f"{result['p50_ms']:>8.1f} {result['p99_ms']:>8.1f} {result['errors']:>7}")
+
+
+if __name__ == "__main__":
+    main()
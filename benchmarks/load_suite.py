@@ -0,0 +1,237 @@
+"""End-to-end load suite for the API.
+
+Drives every endpoint group (object tree, objects, path queries, datapoint reads, listing, batch
+reads and datapoint create/update/delete) against a running server at fixed concurrency levels and
+reports throughput, p50/p95/p99 latency and SQL statements per request for each scenario and level.
+Results can be saved as a baseline and later runs compared against it.
+
+Seed the database first with benchmarks/seed.py and start the server with DEBUG_QUERY_COUNT=true to
+get query counts (read from the X-Query-Count header). Write scenarios create datapoints on seeded
+devices and delete them again, updates change seeded values.
+
+Requires httpx (`pip install httpx`).
+
+Usage: python -m benchmarks.load_suite [--base-url http://localhost:8000] [--levels 1 16 64] [--requests 500]
+       [--scenarios tree get_object ...] [--save baseline.json] [--baseline baseline.json] [--tolerance 0.2]
+"""
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import sys
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List
+
+import httpx
+
+from benchmarks.bench_concurrency import percentile
+
+DEFAULT_LEVELS = [1, 16, 64]
+QUERY_COUNT_HEADER = "x-query-count"
+
+
+@dataclass
+class Targets:
+    """Ids picked from the seeded data through the API
+    """
+    buildings: List[int]
+    rooms: List[int]
+    devices: List[int]
+    datapoints: List[int]
+    created: List[int] = field(default_factory=list)  # datapoints created by the suite, deleted by it
+
+
+def _walk(nodes):
+    for node in nodes:
+        yield node
+        yield from _walk(node["children"])
+
+
+async def discover(client: httpx.AsyncClient) -> Targets:
+    response = await client.get("/api/objects/tree")
+    response.raise_for_status()
+    by_type: Dict[str, List[int]] = {}
+    for node in _walk(response.json()):
+        by_type.setdefault(node["type"], []).append(node["id"])
+
+    response = await client.get("/api/datapoint/", params={"limit": 1000})
+    response.raise_for_status()
+    datapoints = [item["id"] for item in response.json()["items"]]
+
+    targets = Targets(
+        buildings=by_type.get("building", []), rooms=by_type.get("room", []),
+        devices=by_type.get("device", []), datapoints=datapoints,
+    )
+    if not (targets.buildings and targets.rooms and targets.devices and targets.datapoints):
+        sys.exit("The database has no seeded hierarchy, run python -m benchmarks.seed first")
+    return targets
+
+
+def _create_datapoint(client, rng, t: Targets):
+    async def _request():
+        response = await client.post(f"/api/objects/{rng.choice(t.devices)}/datapoint/", json={
+            "name": "load-suite", "value": str(rng.random()), "unit": "C", "type": "temperature", "is_fresh": True,
+        })
+        if response.status_code == 201:
+            t.created.append(response.json()["id"])
+        return response
+    return _request()
+
+
+def _delete_datapoint(client, rng, t: Targets):
+    if not t.created:
+        raise RuntimeError("No datapoint left to delete, the create_datapoint requests are failing")
+    return client.delete(f"/api/datapoint/{t.created.pop()}")
+
+
+# name -> function(client, rng, targets) returning the awaitable of one request; run in this order
+SCENARIOS: Dict[str, Callable] = {
+    "tree": lambda client, rng, t: client.get("/api/objects/tree"),
+    "tree_level": lambda client, rng, t: client.get(
+        "/api/objects/tree", params={"root": rng.choice(t.buildings), "depth": 1}),
+    "get_object": lambda client, rng, t: client.get(f"/api/objects/{rng.choice(t.rooms)}"),
+    "get_objects_batch": lambda client, rng, t: client.get(
+        "/api/objects/batch", params={"ids": rng.sample(t.devices, min(50, len(t.devices)))}),
+    "query_path": lambda client, rng, t: client.get(
+        f"/api/objects/query/{rng.choice(t.buildings)}/building.floor.room.device.temperature"),
+    "query_path_descendants": lambda client, rng, t: client.get(
+        f"/api/objects/query/{rng.choice(t.rooms)}/**.temperature"),
+    "get_datapoint": lambda client, rng, t: client.get(f"/api/datapoint/{rng.choice(t.datapoints)}"),
+    "get_datapoints_batch": lambda client, rng, t: client.get(
+        "/api/datapoint/batch", params={"ids": rng.sample(t.datapoints, min(100, len(t.datapoints)))}),
+    "list_datapoints": lambda client, rng, t: client.get(
+        "/api/datapoint/", params={"type": "temperature", "limit": 100}),
+    "create_datapoint": _create_datapoint,
+    "update_datapoint": lambda client, rng, t: client.put(
+        f"/api/datapoint/{rng.choice(t.datapoints)}", json={"value": f"{rng.uniform(15, 30):.1f}"}),
+    "delete_datapoint": _delete_datapoint,
+}
+
+
+async def run_scenario(client, make_request, targets, concurrency, n_requests, seed=0):
+    """Runs `n_requests` requests of one scenario with at most `concurrency` in flight
+    """
+    rng = random.Random(seed)
+    latencies, query_counts = [], []
+    errors = 0
+    remaining = iter(range(n_requests))
+
+    async def _worker():
+        nonlocal errors
+        for _ in remaining:
+            start = time.perf_counter()
+            response = await make_request(client, rng, targets)
+            latencies.append(time.perf_counter() - start)
+            if response.status_code >= 400:
+                errors += 1
+            if QUERY_COUNT_HEADER in response.headers:
+                query_counts.append(int(response.headers[QUERY_COUNT_HEADER]))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(_worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "throughput": n_requests / elapsed,
+        "p50_ms": percentile(latencies, 50) * 1e3,
+        "p95_ms": percentile(latencies, 95) * 1e3,
+        "p99_ms": percentile(latencies, 99) * 1e3,
+        "mean_ms": statistics.fmean(latencies) * 1e3,
+        "queries": statistics.fmean(query_counts) if query_counts else None,
+        "errors": errors,
+    }
+
+
+def compare(result, baseline, tolerance):
+    """Regressions of one scenario and level against the baseline, as printable strings
+    """
+    regressions = []
+    if result["throughput"] < baseline["throughput"] * (1 - tolerance):
+        regressions.append(f"throughput {baseline['throughput']:.1f} -> {result['throughput']:.1f} req/s")
+    for key in ("p50_ms", "p95_ms", "p99_ms"):
+        if result[key] > baseline[key] * (1 + tolerance):
+            regressions.append(f"{key[:3]} {baseline[key]:.1f} -> {result[key]:.1f} ms")
+    # query counts barely depend on timing (an update without a change skips a few): more than half
+    # a query per request on average means a handler issues more statements than before
+    if result["queries"] is not None and baseline.get("queries") is not None \
+            and result["queries"] > baseline["queries"] + 0.5:
+        regressions.append(f"queries {baseline['queries']:.1f} -> {result['queries']:.1f}")
+    return regressions
+
+
+def _format_row(name, level, result):
+    queries = f"{result['queries']:.1f}" if result["queries"] is not None else "-"
+    return (f"{name:<24} {level:>5} {result['throughput']:>9.1f} {result['p50_ms']:>8.1f} {result['p95_ms']:>8.1f} "
+            f"{result['p99_ms']:>8.1f} {queries:>8} {result['errors']:>7}")
+
+
+async def main_async(args):
+    limits = httpx.Limits(max_connections=max(args.levels), max_keepalive_connections=max(args.levels))
+    async with httpx.AsyncClient(base_url=args.base_url, limits=limits, timeout=120) as client:
+        targets = await discover(client)
+        print(f"{len(targets.buildings)} buildings, {len(targets.rooms)} rooms, {len(targets.devices)} devices, "
+              f"{len(targets.datapoints)} sampled datapoints\n")
+
+        results: Dict[str, Dict[str, dict]] = {}
+        print(f"{'scenario':<24} {'level':>5} {'req/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+              f"{'queries':>8} {'errors':>7}")
+        for name in args.scenarios:
+            make_request = SCENARIOS[name]
+            if name == "delete_datapoint":
+                # unmeasured: the datapoints to delete, on top of those left by create_datapoint
+                needed = min(10, args.requests) + args.requests * len(args.levels) - len(targets.created)
+                if needed > 0:
+                    await run_scenario(client, _create_datapoint, targets, max(args.levels), needed)
+            await run_scenario(client, make_request, targets, 1, min(10, args.requests))  # warm-up
+            for level in args.levels:
+                result = await run_scenario(client, make_request, targets, level, args.requests, seed=level)
+                results.setdefault(name, {})[str(level)] = result
+                print(_format_row(name, level, result))
+
+        # datapoints created without a delete_datapoint run
+        for datapoint_id in targets.created:
+            await client.delete(f"/api/datapoint/{datapoint_id}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--base-url", default="http://localhost:8000")
+    parser.add_argument("--levels", type=int, nargs="+", default=DEFAULT_LEVELS)
+    parser.add_argument("--requests", type=int, default=500, help="requests per scenario and level")
+    parser.add_argument("--scenarios", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument("--save", help="write the results as JSON, e.g. to use as a baseline")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="relative latency/throughput change tolerated before reporting a regression")
+    args = parser.parse_args()
+
+    results = asyncio.run(main_async(args))
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"levels": args.levels, "requests": args.requests, "results": results}, f, indent=2)
+        print(f"\nresults saved to {args.save}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        print(f"\ncompared with {args.baseline} (tolerance {args.tolerance:.0%}):")
+        failed = False
+        for name, levels in results.items():
+            for level, result in levels.items():
+                if level not in baseline.get(name, {}):
+                    continue
+                regressions = compare(result, baseline[name][level], args.tolerance)
+                if regressions:
+                    failed = True
+                    print(f"  REGRESSION {name} @ {level}: " + ", ".join(regressions))
+        if not failed:
+            print("  no regressions")
+        sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
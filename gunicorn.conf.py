@@ -0,0 +1,37 @@
+# Production server: gunicorn -c gunicorn.conf.py main:app
+#
+# Several uvicorn worker processes behind one socket, the app imported once before forking. Every
+# setting can be overridden by its environment variable (see .env.example) or on the command line.
+import multiprocessing
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+# before the app is imported: with several workers, in-process caches must follow each other's writes
+os.environ.setdefault("CACHE_SYNC", "true")
+
+bind = f"{os.getenv('API_HOST', '0.0.0.0')}:{os.getenv('API_PORT', '8000')}"
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+worker_class = "app.server.UvicornWorker"
+
+# import the app in the master: workers start faster and share its memory pages until written
+preload_app = True
+
+# idle keep-alive connections are kept longer than a load balancer keeps them open (60s by default
+# on most), so the balancer never reuses a connection the worker is closing
+keepalive = int(os.getenv("SERVER_KEEPALIVE", 75))
+# pending connections queued by the kernel while all workers are busy
+backlog = int(os.getenv("SERVER_BACKLOG", 2048))
+# on SIGTERM a worker stops accepting, finishes in-flight requests and flushes within this time
+graceful_timeout = int(os.getenv("SERVER_GRACEFUL_TIMEOUT", 30))
+# a worker silent for this long (blocked event loop) is restarted
+timeout = int(os.getenv("SERVER_TIMEOUT", 60))
+
+
+def post_fork(server, worker):
+    # pools copied from the master are dropped without closing its connections; normally there are none,
+    # the app opens connections in the workers only
+    from app.database import async_engine, engine
+    engine.dispose(close=False)
+    async_engine.sync_engine.dispose(close=False)
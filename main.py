@@ -1,36 +1,103 @@
 # See PyCharm help at https://www.jetbrains.com/help/pycharm/
+import asyncio
+import logging
 import os
+from contextlib import asynccontextmanager
 
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse
 from dotenv import load_dotenv
 
-from app.apis import objects, datapoints
+from app import freshness, history, subscriptions
+from app.cache_sync import CACHE_SYNC_ENABLED, cache_sync
+from app.database import env_flag
+from app.instrumentation import InstrumentationMiddleware, request_metrics
+from app.apis import objects, datapoints, admin, subscriptions as subscriptions_api
+from app.warmup import WARMUP_ENABLED, WARMUP_TIMEOUT, check_schema, warmup
+from app.write_behind import write_behind
 
 load_dotenv()
 
-app = FastAPI(
-    title="Hotel Monitoring System API",
-    description="RESTful API for managing hotel objects and datapoints",
-    version="1.0.0"
-)
-
-# Enable CORS
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],  # Modify for production
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
-
-# Include routers
-app.include_router(objects.router, tags=["Objects"])
-app.include_router(datapoints.router, tags=["Datapoints"])
-
-@app.get("/", tags=["Root"])
-async def root():
-    return {"message": "Welcome to Hotel Monitoring System API"}
+logger = logging.getLogger(__name__)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await write_behind.start()
+    background_tasks = []
+    # listening before the warm-up loads the hierarchy, so no change of another worker falls in between
+    if CACHE_SYNC_ENABLED:
+        background_tasks.append(asyncio.create_task(cache_sync.run()))
+    if WARMUP_ENABLED:
+        warmup_task = asyncio.create_task(warmup.run())
+        background_tasks.append(warmup_task)
+        try:
+            await asyncio.wait_for(asyncio.shield(warmup_task), WARMUP_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning("Warm-up not done after %.0fs, serving while it goes on", WARMUP_TIMEOUT)
+    else:
+        await check_schema()
+        warmup.ready = True
+    if history.HISTORY_ENABLED:
+        background_tasks.append(asyncio.create_task(history.run_maintenance()))
+    if freshness.FRESHNESS_ENABLED:
+        background_tasks.append(asyncio.create_task(freshness.run_sweeper()))
+    if subscriptions.SUBSCRIPTIONS_ENABLED:
+        background_tasks.append(asyncio.create_task(subscriptions.run_listener()))
+    yield
+    for task in background_tasks:
+        task.cancel()
+    await write_behind.stop()
+
+
+def create_app() -> FastAPI:
+    app = FastAPI(
+        title="Hotel Monitoring System API",
+        description="RESTful API for managing hotel objects and datapoints",
+        version="1.0.0",
+        lifespan=lifespan
+    )
+
+    # Enable CORS
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=["*"],  # Modify for production
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+        expose_headers=["X-Query-Count"],
+    )
+    app.add_middleware(
+        InstrumentationMiddleware, header=env_flag("DEBUG_QUERY_COUNT", False), exclude_paths=("/metrics", "/ready")
+    )
+
+    # Include routers
+    app.include_router(objects.router, tags=["Objects"])
+    app.include_router(datapoints.router, tags=["Datapoints"])
+    app.include_router(subscriptions_api.router, tags=["Subscriptions"])
+    app.include_router(admin.router, tags=["Admin"])
+
+    @app.get("/", tags=["Root"])
+    async def root():
+        return {"message": "Welcome to Hotel Monitoring System API"}
+
+    @app.get("/ready", include_in_schema=False)
+    async def ready():
+        """200 once the warm-up of this worker has completed, 503 until then
+        """
+        return JSONResponse(warmup.snapshot(), status_code=200 if warmup.ready else 503)
+
+    @app.get("/metrics", include_in_schema=False)
+    async def metrics():
+        """Request metrics of this worker in the Prometheus text format
+        """
+        return PlainTextResponse(request_metrics.render(), media_type="text/plain; version=0.0.4")
+
+    return app
+
+
+app = create_app()
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,12 @@
+-- Append-only history of datapoint values, partitioned by month.
+-- Monthly partitions are created ahead and dropped after the retention period by the
+-- history maintenance task (app/history.py); the default partition catches anything else.
+CREATE TABLE IF NOT EXISTS datapoint_history (
+    "datapoint_FK" integer NOT NULL,
+    ts timestamptz NOT NULL,
+    value_num double precision,
+    value_text text,
+    PRIMARY KEY ("datapoint_FK", ts)
+) PARTITION BY RANGE (ts);
+
+CREATE TABLE IF NOT EXISTS datapoint_history_default PARTITION OF datapoint_history DEFAULT;
@@ -0,0 +1,6 @@
+-- Expiry of the last reading of each datapoint, maintained by the value writers when
+-- DATAPOINT_FRESHNESS_TTLS / DATAPOINT_FRESHNESS_TTL_DEFAULT are set.
+ALTER TABLE datapoint ADD COLUMN IF NOT EXISTS fresh_until timestamptz;
+
+-- Only fresh datapoints can expire: the sweeper reads this index in expiry order.
+CREATE INDEX IF NOT EXISTS ix_datapoint_fresh_until ON datapoint (fresh_until) WHERE is_fresh;
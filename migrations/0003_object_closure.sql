@@ -0,0 +1,11 @@
+-- Closure table of the object hierarchy, maintained by the object write endpoints (app/closure.py).
+CREATE TABLE IF NOT EXISTS object_closure (
+    ancestor_id integer NOT NULL REFERENCES "object" (id) ON DELETE CASCADE,
+    descendant_id integer NOT NULL REFERENCES "object" (id) ON DELETE CASCADE,
+    depth integer NOT NULL,
+    PRIMARY KEY (ancestor_id, descendant_id)
+);
+
+CREATE INDEX IF NOT EXISTS ix_object_closure_descendant_depth ON object_closure (descendant_id, depth);
+
+-- Then fill it from object.parent_id: python -m app.closure backfill
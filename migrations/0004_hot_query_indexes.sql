@@ -0,0 +1,11 @@
+-- Indexes behind the hot endpoint queries, checked by benchmarks/query_plans.py.
+-- CONCURRENTLY keeps writes going on large tables; run this file outside a transaction.
+
+-- children of an object, recursive path CTE, cascade of object deletes
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_object_parent_id ON "object" (parent_id);
+
+-- datapoint -> object lookups (get_datapoint, update_datapoint, update_object_association)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS "ix_object_datapoint_datapoint_FK" ON object_datapoint ("datapoint_FK");
+
+-- datapoints by type
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_datapoint_type ON datapoint (type);
@@ -0,0 +1,12 @@
+-- Composite indexes for the keyset-paginated datapoint listing (GET /api/datapoint/).
+-- Filter column first, sort key last: each filtered page is one bounded index range scan.
+-- CONCURRENTLY: run this file outside a transaction.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_datapoint_type_id ON datapoint (type, id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_datapoint_unit_id ON datapoint (unit, id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_datapoint_is_fresh_id ON datapoint (is_fresh, id);
+
+-- updated_since pages are ordered by (updated_at, id)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_datapoint_updated_at_id ON datapoint (updated_at, id);
+
+-- superseded by ix_datapoint_type_id, which also serves lookups by type alone
+DROP INDEX CONCURRENTLY IF EXISTS ix_datapoint_type;
@@ -0,0 +1,3 @@
+-- Time of the last write of each datapoint's value, maintained by the value writers when
+-- DATAPOINT_WRITE_BEHIND is set: a buffered value is not flushed over a value written after it.
+ALTER TABLE datapoint ADD COLUMN IF NOT EXISTS value_updated_at timestamptz;